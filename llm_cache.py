@@ -0,0 +1,115 @@
+"""
+Persistent cache of chat model responses shared by the agents in mm_agent.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+LLM_CACHE_PATH=os.getenv("MM_LLM_CACHE_PATH",os.path.join(os.path.expanduser("~"),".cache","mmtest","llm_cache.sqlite"))
+
+
+class SQLiteLLMCache(BaseCache):
+    """
+    LangChain cache which keeps model responses in SQLite.
+
+    Entries are keyed by a hash of the model and its parameters (LangChain's llm_string)
+    and the message list with runs of whitespace collapsed. Entries older than ttl seconds
+    are ignored and removed, and beyond max_entries the least recently used are dropped.
+    Generations served from the cache have "from_cache" set in their generation_info.
+
+    Args:
+        path (str, optional): the database file. Defaults to LLM_CACHE_PATH.
+        max_entries (int, optional): most responses kept.
+        ttl (float, optional): seconds a response stays valid. None keeps them until evicted.
+        recent_size (int, optional): number of recent hits also kept deserialized in memory.
+    """
+    def __init__(self, path=None, max_entries=5000, ttl=30*24*3600, recent_size=64):
+        self.path=path or LLM_CACHE_PATH
+        self.recent_size=recent_size
+        self.max_entries=max_entries
+        self.ttl=ttl
+        self.hits=0
+        self.misses=0
+        self.lock=threading.Lock()
+        if self.path!=":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),exist_ok=True)
+        self.recent=OrderedDict() #key -> (response, created) for the most recent hits
+        self.connection=sqlite3.connect(self.path,check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS responses
+                                    (key TEXT PRIMARY KEY, value TEXT, created REAL, used REAL)""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+
+    @staticmethod
+    def key(prompt, llm_string):
+        normalized=re.sub(r'\s+',' ',prompt).strip()
+        return hashlib.sha256(f"{llm_string}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        key=self.key(prompt,llm_string)
+        now=time.time()
+        with self.lock:
+            if key in self.recent:
+                response,created=self.recent[key]
+            else:
+                row=self.connection.execute("SELECT value, created FROM responses WHERE key=?",(key,)).fetchone()
+                response,created=(None,0) if row is None else (loads(row[0]),row[1])
+            if response is None or (self.ttl is not None and now-created>self.ttl):
+                self.recent.pop(key,None)
+                self.misses+=1
+                return None
+            with self.connection:
+                self.connection.execute("UPDATE responses SET used=? WHERE key=?",(now,key))
+            self.recent[key]=(response,created)
+            self.recent.move_to_end(key)
+            if len(self.recent)>self.recent_size:
+                self.recent.popitem(last=False)
+            self.hits+=1
+        return [generation.model_copy(update={"generation_info":{**(generation.generation_info or {}),"from_cache":True}})
+                for generation in response]
+
+    def update(self, prompt, llm_string, return_val):
+        key=self.key(prompt,llm_string)
+        now=time.time()
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?)",(key,dumps(return_val),now,now))
+            if self.ttl is not None:
+                self.connection.execute("DELETE FROM responses WHERE created<?",(now-self.ttl,))
+            self.connection.execute("""DELETE FROM responses WHERE key IN
+                                    (SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)""",
+                                    (self.max_entries,))
+
+    def clear(self, **kwargs):
+        with self.lock, self.connection:
+            self.recent.clear()
+            self.connection.execute("DELETE FROM responses")
+
+    def stats(self):
+        with self.lock:
+            entries=self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits":self.hits,"misses":self.misses,"entries":entries}
+
+
+_llm_cache=None
+_llm_cache_lock=threading.Lock()
+
+def get_llm_cache():
+    """
+    Returns the process-wide SQLiteLLMCache, or None if MM_LLM_CACHE is set to 0.
+    """
+    global _llm_cache
+    if os.getenv("MM_LLM_CACHE","1")=="0":
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache=SQLiteLLMCache()
+    return _llm_cache
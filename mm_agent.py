@@ -1,16 +1,45 @@
 from datetime import datetime
+import functools
+import hashlib
 import json5 as json
-import pickle
+import os
 import re
+import threading
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessageChunk
+from langchain_core.runnables.config import ensure_config, merge_configs
+from langgraph.constants import TAG_NOSTREAM
 from langgraph.graph import Graph
 
 #from langchain.adapters.openai import convert_openai_messages
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 from langchain_openai import ChatOpenAI
-from mytools import markdown_to_html,generate_html_from_html_data,find_direct_quotes,find_missing_strings,load_binary_file_from_url
+from llm_cache import get_llm_cache
+from mytools import markdown_to_html,render_smartstory,get_word_index,prefetch_word_index,ready_word_index,\
+    get_transcript_index,repair_quotes,replace_quote,verify_quotes,unverified_quotes,StreamingJSONParser,\
+    format_significant_items,revision_diff,number_paragraphs,apply_edit_script
 
 MODEL='chatgpt-4o-latest'
 VERSION="4"
+CLIP_PLAYER='shared' #'inline' for a video player before every quote
+STREAMED_NODES=("write","critique") #graph nodes whose text is passed to on_token as it is generated
+FANOUT_MIN_WORDS=2500 #articles at least this long are drafted a section at a time in parallel
+SECTION_SHARES=(1/3,1/6,1/12) #space for the most significant items. the rest share a roundup the size of the last
+MINOR_CRITIQUE_WORDS=60 #longer critiques always get a full rewrite
+LIGHT_CRITIQUE_MAX_CHANGE=.15 #after a minor revision changing less than this, the critic doesn't reread the transcript
+# a critique is minor only if it is about wording or style and asks for nothing which needs the source
+STYLE_CRITIQUE=re.compile(r"\b(wording|word choice|reword|rephrase|phrasing|tighten|concise|wordy|shorter|shorten|trim|"
+                          r"tone|grammar|grammatical|spelling|typo|punctuation|capitali[sz]|passive|active voice|"
+                          r"sentences?|repetiti|redundan|jargon|awkward|clarity|readab|flow|style|subheads?|headline|"
+                          r"formatting)",re.IGNORECASE)
+MAJOR_CRITIQUE=re.compile(r"\b(inaccura|incorrect|wrong|error|mistake|misquot|misrepresent|misleading|fabricat|invent|"
+                          r"verbatim|transcript|missing|omit|leaves? out|add|include|mention|restructur|reorganiz|"
+                          r"rewrite|expand|lede|lead paragraph|fact|names?|named|who|whom|identif|speakers?|said|"
+                          r"quotes?|quotation|votes?|voted|voting|tally|motion|seconded|numbers?|figures?|amounts?|"
+                          r"costs?|dates?|when|where|context|background|explain|details?)",re.IGNORECASE)
+PROMPT_TOKEN_CEILING=int(os.getenv("MM_PROMPT_TOKEN_CEILING","60000")) #largest writer prompt kept after compaction
+# highest temperature at which each node's responses are cached. None never caches.
+CACHE_POLICY={"outliner":.5,"writer":.5,"critique":None,"quote_repair":0}
 
 writing_instructions="""
 Using the transcript or minutes of a meeting provided by the user as your primary source, 
@@ -51,75 +80,358 @@ Special instructions for quotes:
     
 Ensure that your report is engaging, factually accurate, and provides a comprehensive view of the meeting's importance and impact. This approach will help in making the news report informative, insightful, and relevant to the audience.
 """
+shared_instructions="""
+You are part of a newsroom team which reports on meetings. The user provides the transcript or minutes of a meeting
+which is the primary source for everything the team writes. The messages after the source describe your part of the job.
+"""
+
+def source_messages(article):
+    # the leading messages of every prompt about a meeting. they are identical for every call
+    # so the provider can serve them from its prompt cache. instructions for each node follow them
+    return [SystemMessage(content=shared_instructions,additional_kwargs={"mm_kind":"system"}),
+            HumanMessage(content=f"Here is the source document describing the meeting:\n{article['source']}",
+                         additional_kwargs={"mm_kind":"source"})]
+
+def writing_message():
+    # the writer's instructions. the same for the whole draft and for each section so they are cached too
+    return SystemMessage(content=writing_instructions,additional_kwargs={"mm_kind":"instructions"})
+
+HTTP_POOL_LIMITS={"max_connections":20,"max_keepalive_connections":10,"keepalive_expiry":120}
+_chat_models={}
+_chat_models_lock=threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def shared_http_client():
+    # one pooled keep-alive connection pool to the model provider for the whole process
+    import httpx
+    import importlib.util
+    http2=importlib.util.find_spec("h2") is not None #httpx needs h2 for http/2
+    return httpx.Client(http2=http2,limits=httpx.Limits(**HTTP_POOL_LIMITS),timeout=httpx.Timeout(600.0,connect=5.0))
+
+class UsageLogger(BaseCallbackHandler):
+    # prints the prompt tokens the provider reports serving from its prompt cache on each call
+    def __init__(self):
+        self.nodes={}
+        
+    def on_chat_model_start(self,serialized,messages,*,run_id,metadata=None,**kwargs):
+        self.nodes[run_id]=(metadata or {}).get("langgraph_node") or "background"
+        
+    def on_llm_end(self,response,*,run_id,**kwargs):
+        node=self.nodes.pop(run_id,"background")
+        try:
+            generation=response.generations[0][0]
+            message=generation.message
+        except (IndexError,AttributeError):
+            return
+        if (generation.generation_info or {}).get("from_cache"): #answered by the local cache, usage is from the stored call
+            return
+        usage=getattr(message,"usage_metadata",None) or {}
+        prompt_tokens=usage.get("input_tokens")
+        cached=(usage.get("input_token_details") or {}).get("cache_read")
+        if cached is None: #older clients only report it in the raw usage
+            token_usage=message.response_metadata.get("token_usage") or {}
+            prompt_tokens=token_usage.get("prompt_tokens",prompt_tokens)
+            cached=(token_usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if prompt_tokens:
+            print(f"{node}: {cached or 0} of {prompt_tokens} prompt tokens from the provider's cache")
+            
+    def on_llm_error(self,error,*,run_id,**kwargs):
+        self.nodes.pop(run_id,None)
+
+usage_logger=UsageLogger()
+
+def chat_model(node,temperature,**kwargs):
+    # model for a node, using the response cache if CACHE_POLICY allows it at this temperature.
+    # one client is made per combination of settings and api key and shared by every agent and session
+    limit=CACHE_POLICY.get(node,0)
+    cache=get_llm_cache() if limit is not None and temperature<=limit else None
+    api_key=hashlib.sha256(os.getenv("OPENAI_API_KEY","").encode('utf-8')).hexdigest()
+    key=(MODEL,temperature,repr(sorted(kwargs.items())),cache is not None,api_key,os.getenv("OPENAI_BASE_URL"))
+    with _chat_models_lock:
+        if key not in _chat_models:
+            _chat_models[key]=ChatOpenAI(model=MODEL, max_retries=1, temperature=temperature, cache=cache or False,
+                                         http_client=shared_http_client(), stream_usage=True,
+                                         callbacks=[usage_logger], **kwargs)
+        return _chat_models[key]
+
+class JSONStreamHandler(BaseCallbackHandler):
+    # feeds the tokens of a streamed reply to a StreamingJSONParser
+    def __init__(self,parser,on_token=None):
+        self.parser=parser
+        self.on_token=on_token
+        
+    def on_llm_new_token(self,token,**kwargs):
+        self.parser.feed(token)
+        if self.on_token:
+            self.on_token(self.parser)
+
+def invoke_json(model,prompt,on_value=None,on_item=None,on_token=None):
+    # invokes a model which replies with a JSON object, parsing the reply while it streams.
+    # on_value and on_item are passed to StreamingJSONParser. on_token(parser) is called after every token.
+    # returns the text of the reply and the decoded object
+    parser=StreamingJSONParser(on_value,on_item)
+    config=merge_configs(ensure_config(),{"callbacks":[JSONStreamHandler(parser,on_token)]}) #keep the graph's callbacks
+    reply=model.invoke(prompt,config=config,stream=True).content
+    if not parser.text: #served from the cache so nothing streamed
+        parser.feed(reply)
+        if on_token:
+            on_token(parser)
+    return reply,parser.result()
+
 #warning_string="WARNING: the following quotes do not exactly match the transcript"
 #warning_termination="[End of Warning]"
 #pattern=f'{re.escape(warning_string)},*?{re.escape(warning_termination)}'
 
-def check_quotes(article,transcript,prompt):
+def check_quotes(article,transcript,prompt,quotes=None,word_index=None):
     
     # routine to make sure prompts have accurate source
+    # returns the article, the quotes still missing from the transcript and a record of every quote.
+    # quotes holds records from an earlier check so unchanged quotes are not searched again.
 
-    quotes=find_direct_quotes(article)
-    if not quotes:
+    transcript=get_transcript_index(transcript) #built once per source
+    records=verify_quotes(article,transcript,quotes,word_index)
+    if not records:
         print ('no quotes in article')
-        return article,[]
-    missing_quotes=find_missing_strings(quotes,transcript)
+        return article,[],[]
+    missing_quotes=unverified_quotes(records)
     if not missing_quotes:
         print("all quotes found")
-        return article,[]
+        return article,[],records
     display='\n'.join(missing_quotes)
     print(f"quotes missing in draft article:\n{display}")
-    prompt.append(HumanMessage(content=f"""
-        the following quotes from body of the story you wrote were not found verbatim in the source transcript.
-        replace them with quote which are verbatim word for word and letter for letter from the transcript
-        and return only the amended story
-        {display}
-        """
-        ))
-    #lc_messages = convert_openai_messages(prompt)
-    article = ChatOpenAI(model=MODEL, max_retries=1, temperature=0).invoke(prompt).content
-    quotes=find_direct_quotes(article)   
-    if not quotes:
-        print ('no quotes in revised article')
-        return article,[]
-    missing_quotes=find_missing_strings(quotes,transcript)
+    article,missing_quotes=repair_quotes(article,missing_quotes,transcript) #try without the model first
     if not missing_quotes:
-        print("all quotes found in revised article")
-        return article,[]
+        print("all quotes repaired locally")
+        return article,[],verify_quotes(article,transcript,records,word_index)
     display='\n'.join(missing_quotes)
-    print(f"quotes missing after first pass:\n{display}")
-    prompt.append(AIMessage(content=article))
-    prompt.append(HumanMessage(content=f"""
+    print(f"quotes not repaired locally:\n{display}")
+    prompt[:]=compact_prompt(prompt)
+    prompt.append(HumanMessage(additional_kwargs={"mm_kind":"quote_request"},content=f"""
         the following quotes from body of the story you wrote were not found verbatim in the source transcript.
-        They are instead paraphrases.
-        Turn them into indirect quotes with NO quotation marks and follow each with the verbatim text from the transcript
-        which was paraphrased in square brackets and double quotation marks inside the square brackets. We are
-        looking for errors and the text in quotation marks will be used to sync with the transcript and must be absolutely
-        verbatim from the transcript including repeated words and other speaking and trancription errors.
+        For each of them find the passage in the transcript which it comes from and return a replacement 
+        which is verbatim word for word and letter for letter from the transcript.
+        Return only JSON in the following format:
+        {{"replacements": [{{"quote": <the quote exactly as it appears in the story>, "replacement": <verbatim text from the transcript>}}]}}
         {display}
         """
         ))
-    #lc_messages = convert_openai_messages(prompt)
-    article = ChatOpenAI(model=MODEL, max_retries=1, temperature=0).invoke(prompt).content
-    quotes=find_direct_quotes(article)
-    if not quotes:
-        print ('no quotes in second revised article')
-        return article,[]
-    missing_quotes=find_missing_strings(quotes,transcript)
+    request=prompt[-1]
+    optional_params = {
+        "response_format": {"type": "json_object"}}
+    response = chat_model('quote_repair',0,model_kwargs=optional_params).invoke(prompt,config={"tags":[TAG_NOSTREAM]}).content
+    prompt.append(AIMessage(content=response,additional_kwargs={"mm_kind":"quote_reply"}))
+    try:
+        replacements=json.loads(response).get("replacements",[])
+    except (ValueError,AttributeError):
+        replacements=[]
+    for replacement in replacements:
+        if isinstance(replacement,dict) and replacement.get("quote") in missing_quotes and replacement.get("replacement"):
+            article=replace_quote(article,replacement["quote"],replacement["replacement"])
+    records=verify_quotes(article,transcript,records,word_index)
+    if not records:
+        print ('no quotes in revised article')
+        return article,[],[]
+    missing_quotes=unverified_quotes(records)
+    if missing_quotes: #the model's replacements may now be close enough to repair
+        article,missing_quotes=repair_quotes(article,missing_quotes,transcript)
+        records=verify_quotes(article,transcript,records,word_index)
+        missing_quotes=unverified_quotes(records)
     if not missing_quotes:
-        print("all quotes found in second revised article")
-        return article,[]
+        print("all quotes found in revised article")
+        for message in (request,prompt[-1]): #later rounds don't need the exchange
+            message.additional_kwargs['mm_resolved']=True
+        return article,[],records
     display='\n'.join(missing_quotes)
     print(f'article contains unmatched quotes:\n{display}')
-    return article,missing_quotes
+    return article,missing_quotes,records
         
 
+def estimate_tokens(messages):
+    # rough size of a prompt or text. about four characters a token in English plus a few a message
+    if isinstance(messages,str):
+        return len(messages)//4
+    return sum(len(message.content)//4+4 for message in messages)
+
+def critique_severity(critique):
+    # 'none', 'minor' for short critiques which are only about wording and style or 'major' for
+    # anything else. minor critiques are applied without the source so they must not need it
+    if not critique or not critique.strip() or critique.strip()=='None':
+        return 'none'
+    if (len(critique.split())>MINOR_CRITIQUE_WORDS or MAJOR_CRITIQUE.search(critique)
+        or not STYLE_CRITIQUE.search(critique)):
+        return 'major'
+    return 'minor'
+
+def full_pass_seconds(round_stats,node):
+    # seconds taken by the latest full pass of node ('write' or 'critique') or None if there hasn't been one.
+    # for the writer that is a regenerated revision. a first draft is a different job
+    for entry in reversed(round_stats):
+        if entry.get(node) in ('rewrite','full') and not entry.get(f'{node}_script'):
+            return entry[f'{node}_seconds']
+    return None
+
+def compact_prompt(prompt,ceiling=None):
+    # the writer's running prompt without what later rounds have superseded. keeps the system
+    # message, the source, the latest draft and a quote repair which is still unresolved.
+    # earlier drafts and the requests for them are dropped and their critiques summarized.
+    # above the ceiling the summary and then the quote repair go too.
+    # messages are identified by additional_kwargs['mm_kind']. untagged prompts are returned unchanged
+    ceiling=ceiling or PROMPT_TOKEN_CEILING
+    kinds=[message.additional_kwargs.get('mm_kind') for message in prompt]
+    if None in kinds:
+        return prompt
+    drafts=[index for index,kind in enumerate(kinds) if kind=='draft']
+    latest=drafts[-1] if drafts else -1
+    kept,critiques,repair=[],[],[]
+    for index,(message,kind) in enumerate(zip(prompt,kinds)):
+        if kind in ('system','source','instructions'):
+            kept.append(message)
+        elif kind=='revise':
+            critiques.append(message.additional_kwargs.get('mm_critique') or "")
+        elif kind=='summary':
+            critiques.extend(message.additional_kwargs.get('mm_critiques') or [])
+        elif kind in ('quote_request','quote_reply') and index>latest and not message.additional_kwargs.get('mm_resolved'):
+            repair.append(message)
+    critiques=[critique for critique in critiques if critique.strip()]
+    summary=[]
+    if critiques:
+        listed="\n".join(f"- {critique.strip()}" for critique in critiques)
+        summary=[HumanMessage(content=f"Critiques from earlier rounds which have already been addressed:\n{listed}",
+                              additional_kwargs={"mm_kind":"summary","mm_critiques":critiques})]
+    draft=[prompt[latest]] if latest>=0 else []
+    compacted=kept+summary+draft+repair
+    if estimate_tokens(compacted)>ceiling:
+        compacted=kept+draft+repair
+    if estimate_tokens(compacted)>ceiling:
+        compacted=kept+draft
+    before,after=estimate_tokens(prompt),estimate_tokens(compacted)
+    if after>ceiling:
+        print(f"writer prompt of ~{after} tokens is over the ceiling of {ceiling}")
+    if after<before:
+        print(f"writer prompt compacted from ~{before} to ~{after} tokens, ~{before-after} saved")
+    return compacted
+
+def significant_item_texts(significant_items):
+    # one text per item, whether from the outliner's list or the list as edited in the review form
+    if isinstance(significant_items,str):
+        items=re.split(r'\n\s*(?=\d+[.)]\s)',"\n"+significant_items)
+        return [item.strip() for item in items if item.strip()]
+    return [f"{item.get('number','')}. {item.get('description','')} Explanation: {item.get('explanation','')}"
+            if isinstance(item,dict) else str(item) for item in significant_items]
+
+def section_budgets(item_count,words):
+    # words for each major item in order of significance followed by a roundup of the remaining items.
+    # keeps the ratios of SECTION_SHARES and scales them to fill the article
+    shares=list(SECTION_SHARES[:item_count])
+    if item_count>len(SECTION_SHARES):
+        shares.append(SECTION_SHARES[-1])
+    scale=words/sum(shares)
+    return [int(share*scale) for share in shares]
+
+def insert_transition(section,transition):
+    # starts the first paragraph after the section's subhead with a transition sentence
+    if not transition or not transition.strip():
+        return section
+    head,_,rest=section.partition('\n')
+    if head.lstrip().startswith('#') and rest.strip():
+        return f"{head}\n\n{transition.strip()} {rest.lstrip()}"
+    return f"{transition.strip()} {section.lstrip()}"
+
+
+class Speculator:
+    # drafts the article in the background while the editor reviews the outline.
+    # WriterAgent takes the draft if the editor accepts the proposed list unchanged.
+    # otherwise it is discarded. a request already sent to the model finishes but is not used
+    def __init__(self,writer):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        self.writer=writer
+        self.executor=ThreadPoolExecutor(max_workers=2,thread_name_prefix="speculative_writer")
+        self.lock=threading.Lock()
+        self.pending=None
+        self.stats={"started":0,"hits":0,"misses":0,"seconds_saved":0.0}
+        
+    @staticmethod
+    def key(article):
+        # what the first draft depends on. the list is compared as the review form shows it
+        items=" ".join(format_significant_items(article.get('significant_items') or []).split())
+        text="\0".join((items,str(article.get('words')),article.get('source',"")))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+        
+    def draft(self,article):
+        import time
+        
+        return self.writer.writer(article),time.monotonic()
+        
+    def start(self,article):
+        import time
+        
+        speculative=dict(article)
+        # what the review form returns if the editor just clicks OK
+        speculative['significant_items']=format_significant_items(article['significant_items'])
+        speculative['critique']=None
+        self.discard()
+        future=self.executor.submit(self.draft,speculative)
+        with self.lock:
+            self.pending=(self.key(speculative),future,time.monotonic())
+            self.stats["started"]+=1
+        print("speculative draft started")
+        
+    def discard(self):
+        with self.lock:
+            pending,self.pending=self.pending,None
+            if pending is not None:
+                pending[1].cancel()
+                self.stats["misses"]+=1
+        
+    def take(self,article):
+        # returns the speculative draft for article or None if there isn't one which matches
+        import time
+        
+        with self.lock:
+            pending,self.pending=self.pending,None
+        if pending is None:
+            return None
+        key,future,started=pending
+        if key!=self.key(article):
+            future.cancel()
+            self.stats["misses"]+=1
+            print(f"speculative draft discarded. {self.report()}")
+            return None
+        requested=time.monotonic()
+        try:
+            draft,finished=future.result()
+        except Exception as error:
+            self.stats["misses"]+=1
+            print(f"speculative draft failed: {error}")
+            return None
+        self.stats["hits"]+=1
+        self.stats["seconds_saved"]+=min(finished,requested)-started
+        print(f"speculative draft used. {self.report()}")
+        return draft
+        
+    def report(self):
+        resolved=self.stats["hits"]+self.stats["misses"]
+        return (f"hit rate {self.stats['hits']}/{resolved}, "
+                f"{self.stats['seconds_saved']:.1f}s saved")
+
+
 class WriterAgent:
+    def __init__(self,speculator=None):
+        self.speculator=speculator
 
     def writer(self, article):
+        import time
+        
+        started=time.perf_counter()
+        word_index=ready_word_index(article.get('pickle'))
+        quotes=list(article.get('quotes') or [])
+        mode,tokens_saved='draft',0
+        script=None
         if "prompt" in article: #second call to writer
-            prompt=article['prompt']
-            prompt.append(HumanMessage(content=f"""
+            prompt=compact_prompt(article['prompt'])
+            prompt.append(HumanMessage(additional_kwargs={"mm_kind":"revise","mm_critique":article['critique']},
+                                       content=f"""
             revise the article as specified in the critique below returning just the revised article.
             The article must always have subheads in markdown fomat.
             The latest version of the article which is your starting point is here:
@@ -131,8 +443,36 @@ class WriterAgent:
  <end of critique>
              """
             ))
-            response = ChatOpenAI(model=MODEL, max_retries=1, temperature=.5).invoke(prompt).content
-            response_dict={"body":response}
+            severity=critique_severity(article['critique'])
+            if severity=='minor': #wording or style. the transcript and earlier rounds aren't needed
+                edit_prompt=[SystemMessage(content="""
+            You are a copy editor. Make only the changes to the article which are called for in the critique.
+            Do not change anything inside quotation marks. The article must keep its subheads in markdown format.
+            Return only the entire revised article without any comment on the revisions.
+            """),
+                    HumanMessage(content=f"""
+ <article>
+ {article['body']}
+ <end of article>
+ <critique>
+ {article['critique']}
+ <end of critique>
+             """)]
+                messages=edit_prompt
+                mode,tokens_saved='edit',estimate_tokens(prompt)-estimate_tokens(edit_prompt)
+            else:
+                messages=prompt
+                mode='rewrite'
+            # a rewrite keeps the earlier rounds as context. the copy edit needs none
+            script=self.edit_script(prompt[:-1] if mode=='rewrite' else [],article['body'],article['critique'])
+            if script is None: #regenerate the whole article
+                response = chat_model('writer',.5).invoke(messages).content
+                reply=response
+            else:
+                reply,response,_=script
+            change,changed=revision_diff(article['body'],response)
+            response_dict={"body":response,
+                           "revision":{"severity":severity,"change":change,"changed":changed}}
         else: 
  
         
@@ -146,14 +486,8 @@ class WriterAgent:
                 }}
                 """
     
-            prompt = [SystemMessage(content=f"""
-    {writing_instructions}
-
-        """
-    
-            ), HumanMessage(content=f"""Here is the source document describing the meeting:
-                   {article['source']}
-                
+            prompt = source_messages(article)+[writing_message(),
+                HumanMessage(additional_kwargs={"mm_kind":"instructions"},content=f"""
                 Below is a list in descending order of significance of issues covered in the meeting.
                 The first item should be the lede for the story and have approximately 1/3 of the story devoted to it.
                 The second item should have half as much space, the third item even less. The remaining items get just a mention.
@@ -164,20 +498,174 @@ class WriterAgent:
             )]
 
         
-            optional_params = {
-                "response_format": {"type": "json_object"}}
-            response = ChatOpenAI(model=MODEL, max_retries=1, temperature=.5,model_kwargs=optional_params).invoke(prompt).content
-            response_dict=json.loads(response)
+            transcript=get_transcript_index(article['source'])
+            checked=[0] #paragraphs of the body already checked
+            
+            def check_paragraphs(parser):
+                # verify the quotes in each paragraph as soon as it is finished
+                body=parser.partial('body')
+                if not isinstance(body,str):
+                    return
+                paragraphs=body.split('\n')
+                if 'body' not in parser.values: #the last paragraph is still being written
+                    paragraphs.pop()
+                for paragraph in paragraphs[checked[0]:]:
+                    quotes.extend(verify_quotes(paragraph,transcript,quotes,word_index))
+                checked[0]=max(checked[0],len(paragraphs))
+                
+            try:
+                words=int(article['words'])
+            except (KeyError,TypeError,ValueError):
+                words=0
+            items=significant_item_texts(article['significant_items'])
+            if words>=FANOUT_MIN_WORDS and len(items)>1:
+                response,response_dict=self.fan_out(article,items,words)
+            else:
+                optional_params = {
+                    "response_format": {"type": "json_object"}}
+                response,response_dict = invoke_json(chat_model('writer',.5,model_kwargs=optional_params),prompt,
+                                                     on_token=check_paragraphs)
+            reply=response
     
 
 
-        prompt.append(AIMessage(content= response  # Add the AI's response content
-        ))
-        response_dict['body'],response_dict['missing_quotes']=check_quotes(response_dict['body'],article['source'],prompt)
+        prompt.append(AIMessage(content= response,  # Add the AI's response content
+                                additional_kwargs={"mm_kind":"draft"}))
+        response_dict['body'],response_dict['missing_quotes'],response_dict['quotes']=check_quotes(
+            response_dict['body'],article['source'],prompt,quotes,word_index)
         response_dict['prompt']=prompt
+        seconds=time.perf_counter()-started
+        round_stats=list(article.get('round_stats') or [])
+        baseline=full_pass_seconds(round_stats,'write')
+        round_stats.append({"round":len(round_stats)+1,"write":mode,"write_seconds":seconds,
+                            "write_tokens_saved":tokens_saved,"write_script":script is not None,
+                            "write_edits":script[2] if script else None,
+                            "write_output_tokens":estimate_tokens(reply),
+                            "write_seconds_saved":baseline-seconds if mode!='draft' and baseline else 0.0})
+        response_dict['round_stats']=round_stats
+        if mode=='edit' or script is not None:
+            print(f"{mode} by {'edit script' if script else 'regenerating the article'}: ~{tokens_saved} prompt tokens, "
+                  f"~{round_stats[-1]['write_output_tokens']} output tokens and "
+                  f"{round_stats[-1]['write_seconds_saved']:.1f}s saved")
         #print ("writer",VERSION,response_dict["information_suggested"],response_dict["summary"])
         return response_dict
 
+    def edit_script(self, context, body, critique):
+        # asks for the revision as a list of edits instead of the whole article, after the messages
+        # in context. returns the reply, the revised article and the number of edits or None if the
+        # reply can't be used
+        instructions=SystemMessage(content="""
+            You are a newspaper editor. Revise an article as called for in a critique by returning a list of edits
+            to it in JSON, never the revised article itself. Make no changes except those the critique calls for.
+            Text inside quotation marks must stay verbatim from the source.
+            """)
+        request=HumanMessage(content=f"""
+            make only the changes to the article which are called for in the critique below.
+            The paragraphs of the article are numbered in square brackets. The numbers are not part of the article.
+ <article>
+ {number_paragraphs(body)}
+ <end of article>
+ <critique>
+ {critique}
+ <end of critique>
+            Return only JSON in the following format:
+            {{"edits": [{{"paragraph": <number of the paragraph to change>, "old": <the exact text in that paragraph to replace>,
+                          "new": <the text to replace it with>}}]}}
+            Keep each "old" short but long enough to be unique in its paragraph. To add a paragraph give the number of
+            the paragraph it follows (0 for the start) and an empty "old". To remove text give an empty "new".
+            """)
+        optional_params = {
+            "response_format": {"type": "json_object"}}
+        try:
+            reply,script=invoke_json(chat_model('writer',.5,model_kwargs=optional_params),context+[instructions,request])
+            edits=script.get("edits")
+        except (ValueError,AttributeError):
+            print("edit script could not be read")
+            return None
+        if not isinstance(edits,list):
+            print("no edit script in reply")
+            return None
+        revised,failed=apply_edit_script(body,edits)
+        if failed:
+            display='\n'.join(f"{failure['error']}: {failure['edit']}" for failure in failed)
+            print(f"edit script rejected:\n{display}")
+            return None
+        return reply,revised,len(edits)
+
+    def fan_out(self, article, items, words):
+        # drafts the lede, each major item and a roundup of the rest in parallel then stitches
+        # them together with a short pass which returns the headline, summary and transitions
+        import time
+        
+        budgets=section_budgets(len(items),words)
+        sections=[[item] for item in items[:len(SECTION_SHARES)]]
+        if len(items)>len(SECTION_SHARES):
+            sections.append(items[len(SECTION_SHARES):])
+        prompts=[]
+        for number,(section,budget) in enumerate(zip(sections,budgets)):
+            if number==0:
+                task="""This section opens the story. Begin with a lead paragraph on the item below, which is the most
+                significant of the meeting, then continue under a markdown subhead."""
+            elif len(section)==1:
+                task="Write the section of the story about the item below. Begin it with a markdown subhead."
+            else:
+                task="Briefly mention each of the items below in a single section. Begin it with a markdown subhead."
+            listed="\n".join(section)
+            prompts.append(source_messages(article)+[writing_message(),HumanMessage(content=f"""
+                This news report is being written one section at a time. You will write one section.
+                Other sections will cover the other items so do not write a headline, an introduction to the whole
+                meeting or a closing which sums up the meeting.
+                {task}
+                The section should be about {budget} words divided into paragraphs and formatted as markdown.
+                {listed}
+                Return only the markdown of the section.
+                """)])
+        started=time.perf_counter()
+        # sections are tagged nostream because their tokens would be interleaved
+        drafted=chat_model('writer',.5).batch(prompts,config={"max_concurrency":len(prompts),"tags":[TAG_NOSTREAM]})
+        drafted=[reply.content.strip() for reply in drafted]
+        print(f"drafted {len(drafted)} sections in parallel in {time.perf_counter()-started:.1f}s")
+        
+        sample_json=f"""
+                {{
+                  "title": title of the article,
+                  "date": meeting date,
+                  "transitions": a list of {len(drafted)-1} strings, one for each section after the first. Each is a short sentence
+                                 which will start that section and lead into it from the section before. Use an empty string if none is needed,
+                  "closing": a short closing paragraph for the article,
+                  "information_suggested": information not in the transcript or minutes which would be helpful to a more complete story,
+                  "summary": 2 sentences summary of the article
+                }}
+                """
+        numbered="\n\n".join(f"<section {number}>\n{section}\n<end of section {number}>"
+                               for number,section in enumerate(drafted,1))
+        stitch_prompt=source_messages(article)+[SystemMessage(content="""
+            You are a newspaper editor. Sections of a news report on a meeting were written separately by different
+            reporters in order of significance. Your job is to supply what joins them into one story without rewriting them.
+            """),
+            HumanMessage(content=f"""
+                Here are the sections in order:
+                {numbered}
+                Return nothing but JSON in the following format:
+            {sample_json}
+                """)]
+        started=time.perf_counter()
+        optional_params = {
+            "response_format": {"type": "json_object"}}
+        _,stitch=invoke_json(chat_model('writer',.5,model_kwargs=optional_params),stitch_prompt)
+        print(f"stitched in {time.perf_counter()-started:.1f}s")
+        transitions=stitch.pop('transitions',None) or []
+        if not isinstance(transitions,list) or not all(isinstance(transition,str) for transition in transitions):
+            print(f"ignoring malformed transitions from the stitch pass: {transitions!r:.200}")
+            transitions=[]
+        body=[drafted[0]]+[insert_transition(section,transitions[number] if number<len(transitions) else "")
+                           for number,section in enumerate(drafted[1:])]
+        closing=stitch.pop('closing',"")
+        if isinstance(closing,str) and closing.strip():
+            body.append(closing.strip())
+        stitch['body']="\n\n".join(body)
+        return json.dumps(stitch,quote_keys=True,ensure_ascii=False),stitch
+
     def revise(self, article: dict):
         sample_revise_json = """
             {
@@ -213,10 +701,11 @@ class WriterAgent:
             "response_format": {"type": "json_object"}
         }
         article['critique']=""
-        response = ChatOpenAI(model=MODEL, max_retries=1, temperature=.5).invoke(prompt).content
+        response = chat_model('writer',.5).invoke(prompt).content
 
-        revision=check_quotes(response,article['source'],prompt)
-        return {"body":revision}
+        revision,missing_quotes,quotes=check_quotes(response,article['source'],prompt,article.get('quotes'),
+                                                    ready_word_index(article.get('pickle')))
+        return {"body":revision,"missing_quotes":missing_quotes,"quotes":quotes}
 
     def run(self, article: dict):
         print(f"writer {VERSION} working...,{article.keys()}")
@@ -224,16 +713,20 @@ class WriterAgent:
         if critique is not None:
             article.update(self.writer(article)) #will remove redundent code if test woks
         else:
-            article.update(self.writer( article))
+            draft=self.speculator.take(article) if self.speculator and "prompt" not in article else None
+            article.update(draft or self.writer( article))
         return article
 
 
 class CritiqueAgent:
 
     def critique(self, article: dict):
+        import time
+        
         #short_article=article.copy()
         #del short_article['source'] #to save tokens
-        prompt = [SystemMessage(content= """"
+        started=time.perf_counter()
+        critiquer=SystemMessage(content= """"
             You are a newspaper writing critiquer. Your ask is to provide short feedback on a written "
             article which the user will provide you.
             the article is a news story so should not include editorial comments.
@@ -242,27 +735,53 @@ class CritiqueAgent:
             if you think the article is as good as it can be, please return only the word 'None' without the surrounding hash marks.
             Try to find at least one thing to improve in the article""
             """
-        ), HumanMessage(content= f"""
+        )
+        # the date comes after the source so the source stays a cacheable prefix
+        prompt = source_messages(article)+[critiquer, HumanMessage(content= f"""
             Today's date is {datetime.now().strftime('%d/%m/%Y')}.
-            The article and the transcript on which it is based are in the text below:
-            <transcript>
-            {article['source']}
-            <end transcript>
+            The article is based on the source above. Here it is:
             <article>
             {article['body']}
             <end article>
             """
                   
         )] 
+        revision=article.get('revision') or {}
+        light=revision.get('severity')=='minor' and revision.get('change',1)<=LIGHT_CRITIQUE_MAX_CHANGE
+        if light: #a small edit for a minor critique. the transcript was checked in earlier rounds
+            changed="\n".join(revision.get('changed') or [])
+            light_prompt=[critiquer,HumanMessage(content= f"""
+            Today's date is {datetime.now().strftime('%d/%m/%Y')}.
+            The article below was checked against the transcript of the meeting in an earlier round and has since
+            had minor edits. Only the passages listed as changed are new.
+            <article>
+            {article['body']}
+            <end article>
+            <changed passages>
+            {changed}
+            <end changed passages>
+            """
+            )]
+            tokens_saved=estimate_tokens(prompt)-estimate_tokens(light_prompt)
+            prompt=light_prompt
 
         #lc_messages = convert_openai_messages(prompt)
-        response = ChatOpenAI(model=MODEL,temperature=1.0, max_retries=1).invoke(prompt).content
+        response = chat_model('critique',1.0).invoke(prompt).content
+        seconds=time.perf_counter()-started
+        round_stats=[dict(entry) for entry in article.get('round_stats') or [{"round":1}]]
+        baseline=full_pass_seconds(round_stats,'critique')
+        round_stats[-1].update({"critique":'light' if light else 'full',"critique_seconds":seconds,
+                                "critique_tokens_saved":tokens_saved if light else 0,
+                                "critique_seconds_saved":baseline-seconds if light and baseline else 0.0})
+        if light:
+            print(f"critique without the transcript: ~{tokens_saved} prompt tokens and "
+                  f"{round_stats[-1]['critique_seconds_saved']:.1f}s saved")
         if response == 'None':
-            return {'critique': None}
+            return {'critique': None,'round_stats':round_stats}
         else:
             print(f"For article: {article['title']}")
             print(f"Feedback: {response}\n")
-            return {'critique': response, 'message': None}
+            return {'critique': response, 'message': None,'round_stats':round_stats}
 
     def run(self, article: dict):
         print("critiquer working...",article.keys())
@@ -280,6 +799,8 @@ class InputAgent:
         
         print ("input agent running...")
         print(article.keys())
+        if "pickle" in article: #timing data is only needed by OutputAgent. fetch it while the model works
+            prefetch_word_index(article["pickle"],article.get("video"))
         if "transcript" in article:
             the_text=load_text_from_url(article["transcript"])
 
@@ -291,27 +812,35 @@ class InputAgent:
                 the_text=extract_text(content=article['raw'],content_type=article["file_name"].split('.')[-1])
                 del article["raw"]
             else:
-                the_text=load_text_from_path(article['file_name'])
+                try:
+                    the_text=load_text_from_path(article['file_name'])
+                finally:
+                    if article.pop("spooled",False): #temporary copy of an upload
+                        os.remove(article['file_name'])
         delimiter='Select text if you\'d like to play only a clip.\nPlay Clip\nPlay Full Video\nPause\n\n\n            Your browser does not support the video tag'
         real_end=the_text.find(delimiter) #temporary kluge for using the transcript
         if real_end!=-1:
             the_text=the_text[:real_end]
         article["source"]=the_text
+        get_transcript_index(the_text) #index once for all later quote checks
         return article
             
 class OutputAgent:
     def run(self,article:dict):
         #print(f"Title: {article['title']}\nSummary: {article['summary']}\nBody:{article['body']}")
-        markdown_article=markdown_to_html(article['body'],title=article['title'],date=article['date'],
-                                  smart_transcript=article.get('url'))
         if 'pickle' in article: #if we are supposed to make smartstory
             article["output_name"]="SmartStory.html"
-            pickle_data=load_binary_file_from_url(article['pickle'])
-            deepgram_return=pickle.loads(pickle_data)
-            article['formatted'],article["missing_quotes"]=generate_html_from_html_data(markdown_article,article['video'],deepgram_return)
+            word_index=get_word_index(article['pickle'],article.get('video')) #prefetched by InputAgent
+            article['formatted'],article["missing_quotes"]=render_smartstory(article['body'],article['video'],
+                                                                             word_index=word_index,
+                                                                             quote_records=article.get('quotes'),
+                                                                             title=article['title'],date=article['date'],
+                                                                             smart_transcript=article.get('url'),
+                                                                             player=CLIP_PLAYER)
         else:
             article["output_name"]="Story.html"
-            article['formatted']=markdown_article
+            article['formatted']=markdown_to_html(article['body'],title=article['title'],date=article['date'],
+                                  smart_transcript=article.get('url'))
         #print (article['formatted'])
         
         article['form']=3 
@@ -344,14 +873,13 @@ based on the transcript or meeting description provided by the user:
 In a message below the user has requested changes to the list which you must now accomplish.
 """
 
-        the_prompts=[SystemMessage(content=f"""
+        the_prompts=source_messages(article)+[SystemMessage(content=f"""
              {revise_prompt_content if 'revisons' in article else start_prompt_content}
              Return only JSON in the following format:
             {sample_json}
             """),
             HumanMessage(content=f"""
-            This is the source information for the meeting
-            {article['source']}.
+            Make the list from the source information for the meeting above.
             {"this is how I'd lke you to revise it:"+ article["critique"] if "critique" in article else ""}
             """ 
              )]
@@ -361,8 +889,12 @@ In a message below the user has requested changes to the list which you must now
         optional_params = {
             "response_format": {"type": "json_object"}
         }
-        reply = ChatOpenAI(model=MODEL, max_retries=1, temperature=.5,model_kwargs=optional_params).invoke(the_prompts)
-        response_dict=json.loads(reply.content)
+        def show_item(key,index,item):
+            if key=='significant_items' and isinstance(item,dict):
+                print(f"significant item {index+1}: {item.get('description')}")
+                
+        reply,response_dict = invoke_json(chat_model('outliner',.5,model_kwargs=optional_params),the_prompts,
+                                          on_item=show_item)
         article.update(response_dict)
         article["form"]=2
         return(article)
@@ -402,7 +934,8 @@ class StateMachine:
 
         start_agent=StartAgent()
         input_agent=InputAgent()
-        writer_agent = WriterAgent()
+        self.speculator=Speculator(WriterAgent())
+        writer_agent = WriterAgent(self.speculator)
         critique_agent = CritiqueAgent()
         output_agent=OutputAgent()
         human_review=HumanReviewAgent()
@@ -449,25 +982,47 @@ class StateMachine:
             return values[last_state]
         return result
         
-    def resume(self,new_values:dict):
+    def resume(self,new_values:dict,on_token=None):
+        # on_token(node,text) if given is called with each piece of text the model
+        # generates in the nodes in STREAMED_NODES as it arrives
         values=self.chain.get_state(self.thread).values
         #last_state=self.chain.get_state(self.thread).next[0].split(':')[0]
         last_state=next(iter(values))
         #print(self.chain.get_state(self.thread))
         values[last_state].update(new_values)
         self.chain.update_state(self.thread,values[last_state])
-        result=self.chain.invoke(None,self.thread,output_keys=last_state)
+        if on_token is None:
+            result=self.chain.invoke(None,self.thread,output_keys=last_state)
+        else:
+            result=self.stream(on_token)
         #print("r",result)
         if result is None:
             values=self.chain.get_state(self.thread).values
             last_state=next(iter(values))
-            return self.chain.get_state(self.thread).values[last_state]
+            result=self.chain.get_state(self.thread).values[last_state]
+        if result.get("form")==2: #draft while the editor reviews the outline
+            self.speculator.start(result)
         return result       
+    
+    def stream(self,on_token):
+        result=None
+        for mode,chunk in self.chain.stream(None,self.thread,stream_mode=["messages","updates"]):
+            if mode=="messages":
+                message,metadata=chunk
+                node=metadata.get("langgraph_node")
+                # only chunks as they are generated. whole messages are the node's prompt or a cached reply
+                if node in STREAMED_NODES and isinstance(message,AIMessageChunk) and message.content:
+                    on_token(node,message.content)
+            else:
+                for node,writes in chunk.items():
+                    if not node.startswith("__"): #skip interrupt markers
+                        result=writes[node] #output of the node which just ran
+        return result
       
 
 if __name__ == '__main__': #test code
     
-    from mm_tkinter import process_form
+    from mm_tkinter import process_form, stream_window
 
        
     sm=StateMachine()
@@ -476,5 +1031,9 @@ if __name__ == '__main__': #test code
         new_values=process_form(result["form"],result)
         if 'quit' in result:
             break
-        result=sm.resume (new_values)
+        on_token,close=stream_window()
+        try:
+            result=sm.resume (new_values,on_token=on_token)
+        finally:
+            close()
     
\ No newline at end of file
@@ -20,6 +20,8 @@ def save_file_dialog(file_object,suggested_file_name):
     )
     
 def process_form(form_number,article):
+    from mytools import format_significant_items
+    
     def set_s3():
         print('setting s3 values')
         st.session_state["newvalues"]["transcript"]=st.query_params["transcript"]
@@ -33,8 +35,15 @@ def process_form(form_number,article):
         del st.session_state.newvalues["next"]
         
     def set_file():
-        st.session_state["newvalues"].update({"raw":st.session_state.input_file.getvalue(),
-                                     "file_name":st.session_state.input_file.name})
+        import shutil
+        import tempfile
+        
+        # spool the upload to disk once so only its path travels in the graph state
+        upload=st.session_state.input_file
+        upload.seek(0)
+        with tempfile.NamedTemporaryFile(suffix="."+upload.name.split('.')[-1],delete=False) as spool:
+            shutil.copyfileobj(upload,spool)
+        st.session_state["newvalues"].update({"file_name":spool.name,"spooled":True})
         
         del st.session_state.newvalues["next"]
     def do_first_dialog():
@@ -127,11 +136,7 @@ def process_form(form_number,article):
             )
 
     elif form_number==2:
-        formatted_items=[]
-        for item in article['significant_items']:
-            formatted_item = f"{item['number']}. {item['description']}\n    Explanation: {item['explanation']}\n"
-            formatted_items.append(formatted_item)
-        formatted_text = "\n".join(formatted_items)
+        formatted_text = format_significant_items(article['significant_items'])
         do_review_dialog(
         header="significant items",
         initial_contents=[formatted_text,""],
@@ -147,6 +152,30 @@ def process_form(form_number,article):
     )
 
         
+def live_text():
+    """
+    Returns a callback for StateMachine.resume which shows the text of the writer and
+    critique as it is generated.
+    """
+    import time
+    from mytools import StreamingJSONParser, article_preview
+    
+    titles={"write":"The writer is drafting...","critique":"The critic is reading..."}
+    placeholder=st.empty()
+    streamed={"node":None,"text":"","shown":0}
+    
+    def on_token(node,text):
+        if node!=streamed["node"]:
+            streamed.update({"node":node,"text":"","parser":StreamingJSONParser()})
+        streamed["text"]+=text
+        streamed["parser"].feed(text) #first drafts arrive as JSON
+        if time.monotonic()-streamed["shown"]>0.1: #don't redraw for every token
+            streamed["shown"]=time.monotonic()
+            with placeholder.container():
+                st.subheader(titles.get(node,node))
+                st.markdown(article_preview(streamed["text"],streamed["parser"]))
+    return on_token
+        
 def rerun():
     st.session_state['dm'] = None
     st.session_state['result']=None
@@ -244,7 +273,8 @@ if st.session_state["result"]:
             print("*********")
             #st.session_state["newvalues"]
             with st.spinner("Please wait... Bots at work"):
-                st.session_state["result"]=st.session_state['dm'].resume(st.session_state["newvalues"])
+                st.session_state["result"]=st.session_state['dm'].resume(st.session_state["newvalues"],
+                                                                          on_token=live_text())
             if 'missing_quotes' in st.session_state["result"]:
                 print(f"missing quotes2: {st.session_state['result']['missing_quotes']}")
             st.session_state["newvalues"]=None
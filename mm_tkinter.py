@@ -23,6 +23,50 @@ def save_file_dialog(file_object, suggested_filename):
                 f.write(file_object.read())
     return file_path
 
+def stream_window(title="Bots at work"):
+    """
+    Opens a window which shows the text of the writer and critique as it is generated.
+    
+    Returns:
+        tuple: an on_token(node, text) callback for StateMachine.resume and a function
+               which closes the window.
+    """
+    import tkinter as tk
+    from tkinter import scrolledtext
+    from mytools import StreamingJSONParser, article_preview
+    
+    titles={"write":"The writer is drafting...","critique":"The critic is reading..."}
+    root = tk.Tk()
+    root.title(title)
+    label=tk.Label(root,text="Please wait... Bots at work")
+    label.pack(fill=tk.X)
+    text_box = scrolledtext.ScrolledText(root, height=30, wrap=tk.WORD)
+    text_box.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+    current={"node":None}
+    
+    def on_token(node,text):
+        if node!=current["node"]: #new node. start again
+            current.update({"node":node,"text":"","shown":"","parser":StreamingJSONParser()})
+            label.config(text=titles.get(node,node))
+            text_box.delete('1.0',tk.END)
+        current["text"]+=text
+        current["parser"].feed(text) #first drafts arrive as JSON
+        preview=article_preview(current["text"],current["parser"])
+        if preview.startswith(current["shown"]):
+            text_box.insert(tk.END,preview[len(current["shown"]):])
+        else:
+            text_box.delete('1.0',tk.END)
+            text_box.insert(tk.END,preview)
+        current["shown"]=preview
+        text_box.see(tk.END)
+        root.update()
+        
+    def close():
+        root.destroy()
+        
+    root.update()
+    return on_token,close
+
 def article_options():
     import tkinter as tk
     
@@ -73,6 +117,7 @@ def article_options():
 
 def process_form(form:int,article):
     from tkinter import filedialog
+    from mytools import format_significant_items
     
     if form==0:
         answer = article_options()
@@ -101,11 +146,7 @@ def process_form(form:int,article):
         missing_quotes=[] if 'missing_quotes' not in article else article['missing_quotes']
     )
     elif form==2:
-        formatted_items=[]
-        for item in article['significant_items']:
-            formatted_item = f"{item['number']}. {item['description']}\n    Explanation: {item['explanation']}\n"
-            formatted_items.append(formatted_item)
-        formatted_text = "\n".join(formatted_items)
+        formatted_text = format_significant_items(article['significant_items'])
         answer= open_review_dialog(
         header="significant items",
         initial_contents=[formatted_text,""],
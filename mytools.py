@@ -9,14 +9,19 @@ from typing import Optional, Any, Annotated, List, Dict, Literal
 
 
 from pydantic import BaseModel, Field
+import collections
+import contextlib
+import functools
+import os
 import string
 import re
+import threading
 import requests
 
 def load_binary_file_from_url(url):
     try:
         # Send a GET request to the URL
-        response = requests.get(url)
+        response = cached_get(url)
 
         # Check if the request was successful
         response.raise_for_status()
@@ -30,6 +35,9 @@ def load_binary_file_from_url(url):
         print(f"An error occurred: {e}")
         return None
     
+# Regular expression to handle double quotes and single quotes with embedded apostrophes
+QUOTE_PATTERN = re.compile(r'["“](.*?)["”]')
+
 def find_direct_quotes(text):
     """
     Finds all direct quotes in a given text string, handling embedded apostrophes.
@@ -41,13 +49,176 @@ def find_direct_quotes(text):
         list: A list of strings containing the direct quotes found in the text. 
               The list may be empty if no quotes are found.
     """
-    # Regular expression to handle double quotes and single quotes with embedded apostrophes
-    pattern = r'["“](.*?)["”]'
+    return QUOTE_PATTERN.findall(text)
+
+def find_direct_quote_spans(text):
+    """
+    Finds all direct quotes in text with their positions.
+
+    Returns:
+        list: (start, end, quote) for each quote, where start and end are the offsets
+              of the quoted words inside the quotation marks.
+    """
+    return [(match.start(1),match.end(1),match.group(1)) for match in QUOTE_PATTERN.finditer(text)]
+
+def quote_key(quote):
+    """
+    Normalized form of a quote which survives the character scrubbing of markdown_to_html.
+    """
+    return TranscriptIndex.normalize(replace_special_characters(quote))
+
+def verify_quotes(text, transcript, previous=None, word_index=None):
+    """
+    Returns a record for each direct quote in text.
     
-    # Find all matches
-    matches = re.findall(pattern, text)
+    Each record is a dictionary with the quote 'text', its 'article_start' and
+    'article_end' offsets, the 'transcript_start' and 'transcript_end' offsets where
+    it was found, its 'clip_start' and 'clip_end' times in seconds and whether it is
+    'verified' verbatim. Offsets and times are None when not found.
     
-    return matches
+    Args:
+        text (str): The article.
+        transcript (str or TranscriptIndex): The text of the transcript or its index.
+        previous (list, optional): records from an earlier check. Quotes which are unchanged
+            keep their earlier results instead of being searched again.
+        word_index (WordIndex, optional): index of the timed transcript for finding clips.
+    """
+    index=get_transcript_index(transcript)
+    known={record['text']:record for record in previous or []}
+    spans=find_direct_quote_spans(text)
+    hits=index.find_all([quote for _,_,quote in spans if quote not in known])
+    records=[]
+    for start,end,quote in spans:
+        if quote in known:
+            record=dict(known[quote])
+        else:
+            hit=hits[quote]
+            record={"text":quote,
+                    "transcript_start":hit[0] if hit else None,
+                    "transcript_end":hit[1] if hit else None,
+                    "clip_start":None,"clip_end":None,
+                    "verified":hit is not None}
+        if word_index is not None and record['verified'] and record['clip_start'] is None:
+            clips=word_index.find(quote)
+            if clips:
+                record['clip_start'],record['clip_end']=clips[0]
+        record['article_start']=start
+        record['article_end']=end
+        records.append(record)
+    return records
+
+def unverified_quotes(records):
+    """
+    Returns the distinct quotes in records which were not found in the transcript.
+    """
+    return list(dict.fromkeys(record['text'] for record in records if not record['verified']))
+
+class TranscriptIndex:
+    """
+    Normalized copy of a transcript for verifying batches of quotes.
+    
+    Punctuation, spaces and newlines are removed and the text is lowercased once,
+    keeping a map from each normalized character back to its offset in the original
+    text. Build one per source document and reuse it for every verification pass.
+    
+    Args:
+        transcript (str): The text of the transcript.
+    """
+    translator = str.maketrans('', '', string.punctuation)
+    skip=frozenset(string.punctuation+" \n")
+    
+    def __init__(self, transcript):
+        self.transcript=transcript
+        self.aligner=None
+        self.word_spans=None
+        self.aligner_lock=threading.Lock()
+        lowered=transcript.lower()
+        if len(lowered)==len(transcript): #usual case. lowering doesn't change offsets
+            self.offsets=[i for i,c in enumerate(lowered) if c not in self.skip]
+            self.normalized="".join([lowered[i] for i in self.offsets])
+        else: #some characters lowercase to more than one character
+            chars=[]
+            self.offsets=[]
+            for i,c in enumerate(transcript):
+                if c not in self.skip:
+                    c=c.lower()
+                    chars.append(c)
+                    self.offsets.extend([i]*len(c))
+            self.normalized="".join(chars)
+            
+    @classmethod
+    def normalize(cls, text):
+        return text.translate(cls.translator).replace(" ", "").replace("\n","").lower()
+    
+    def find(self, quote):
+        """
+        Returns the (start, end) character offsets in the original transcript of the
+        first occurrence of quote or None if it does not occur.
+        """
+        normalized_quote=self.normalize(quote)
+        if not normalized_quote:
+            return (0,0)
+        position=self.normalized.find(normalized_quote)
+        if position==-1:
+            return None
+        return (self.offsets[position],self.offsets[position+len(normalized_quote)-1]+1)
+    
+    def find_all(self, quotes):
+        """
+        Returns a dictionary mapping each quote to its (start, end) offsets in the
+        original transcript or to None if it does not occur.
+        """
+        hits={}
+        for quote in quotes:
+            if quote not in hits:
+                hits[quote]=self.find(quote)
+        return hits
+    
+    def missing(self, quotes):
+        hits=self.find_all(quotes)
+        return [quote for quote in quotes if hits[quote] is None]
+    
+    def fuzzy_find(self, quote, min_ratio=0.6):
+        """
+        Finds the span of the transcript closest to a quote which may not be verbatim.
+        
+        Returns:
+            dict: 'start' and 'end' character offsets in the original transcript, the
+                  verbatim 'text' there, and the alignment 'score' and 'ratio', or None
+                  if nothing is close enough.
+        """
+        if self.aligner is None:
+            with self.aligner_lock: #the index is shared between sessions and threads
+                if self.aligner is None:
+                    tokens=[]
+                    spans=[]
+                    for match in re.finditer(r'[^\s-]+',self.transcript):
+                        token=strip_punctuation(match.group())
+                        if token:
+                            tokens.append(token)
+                            spans.append(match.span())
+                    self.word_spans=spans
+                    self.aligner=FuzzyAligner(tokens)
+        words=[word for word in WordIndex.quote_tokens(quote) if word]
+        result=self.aligner.align(words,min_ratio=min_ratio)
+        if result is None:
+            return None
+        start=self.word_spans[result['start']][0]
+        end=self.word_spans[result['end']-1][1]
+        return {"start":start,"end":end,"text":self.transcript[start:end],
+                "score":result['score'],"ratio":result['ratio']}
+    
+@functools.lru_cache(maxsize=4)
+def _cached_transcript_index(transcript):
+    return TranscriptIndex(transcript)
+
+def get_transcript_index(transcript):
+    """
+    Returns the TranscriptIndex for transcript, building it only the first time it is seen.
+    """
+    if isinstance(transcript,TranscriptIndex):
+        return transcript
+    return _cached_transcript_index(transcript)
 
 def find_missing_strings(strings, transcript):
     """
@@ -56,23 +227,355 @@ def find_missing_strings(strings, transcript):
     
     Args:
         strings (list): List of strings to check.
-        transcript (str): The text of the transcript.
+        transcript (str or TranscriptIndex): The text of the transcript or its index.
     
     Returns:
         list: Strings that are not found in the transcript.
     """
-    # Normalize transcript by removing punctuation, converting to lower case, and removing spaces
-    translator = str.maketrans('', '', string.punctuation)
-    normalized_transcript = transcript.translate(translator).replace(" ", "").replace("\n","").lower()
+    return get_transcript_index(transcript).missing(strings)
+
+def replace_quote(text, quote, replacement):
+    """
+    Replaces the first direct quote in text whose contents are quote with replacement,
+    keeping the quotation marks.
+    """
+    pattern=r'(["“])'+re.escape(quote)+r'(["”])'
+    return re.sub(pattern,lambda m: m.group(1)+replacement+m.group(2),text,count=1)
+
+def make_indirect_quote(text, quote, verbatim):
+    """
+    Turns the direct quote of quote in text into an indirect one followed by the
+    verbatim transcript text in square brackets and quotation marks.
+    """
+    pattern=r'["“]'+re.escape(quote)+r'["”]'
+    return re.sub(pattern,lambda m: f'{quote} ["{verbatim}"]',text,count=1)
+
+def repair_quotes(text, missing_quotes, transcript, verbatim_ratio=0.8, indirect_ratio=0.5):
+    """
+    Fixes quotes which are not verbatim from the transcript without a call to the model.
     
-    # Find strings not in the transcript
-    missing_strings = []
-    for s in strings:
-        normalized_string = s.translate(translator).replace(" ", "").replace("\n","").lower()
-        if normalized_string not in normalized_transcript:
-            missing_strings.append(s)
+    Each quote is aligned against the transcript. If the closest span is nearly the
+    same the quote is replaced by the verbatim span. If it is only similar the quote
+    becomes an indirect quote followed by the verbatim span in square brackets.
     
-    return missing_strings
+    Args:
+        text (str): The article.
+        missing_quotes (list): quotes in the article not found in the transcript.
+        transcript (str or TranscriptIndex): The text of the transcript or its index.
+        verbatim_ratio (float, optional): minimum alignment ratio for substituting the verbatim span.
+        indirect_ratio (float, optional): minimum alignment ratio for converting to an indirect quote.
+        
+    Returns:
+        tuple: the repaired article and a list of quotes which could not be repaired.
+    """
+    index=get_transcript_index(transcript)
+    unrepaired=[]
+    for quote in missing_quotes:
+        nearest=index.fuzzy_find(quote,min_ratio=indirect_ratio)
+        if nearest is None:
+            unrepaired.append(quote)
+            continue
+        # quotation marks and brackets inside the span would break the quote
+        verbatim=" ".join(re.sub(r'["“”\[\]]','',nearest['text']).split())
+        if nearest['ratio']>=verbatim_ratio:
+            repaired=replace_quote(text,quote,verbatim)
+        else:
+            repaired=make_indirect_quote(text,quote,verbatim)
+        if repaired==text:
+            unrepaired.append(quote)
+        else:
+            print(f"repaired quote: {quote} -> {verbatim}")
+            text=repaired
+    return text,unrepaired
+
+class StreamingJSONParser:
+    """
+    Parses a JSON object as it arrives in pieces, such as a model's streamed reply.
+    
+    Text is scanned once as it is fed. Each top-level member is decoded as soon as it
+    is complete and passed to on_value(key, value), and each element of a top-level
+    array is passed to on_item(key, index, item) without waiting for the rest of the
+    array. Values are decoded with the json module, falling back to json5 for the
+    lenient JSON models sometimes return.
+    
+    Args:
+        on_value (callable, optional): called with the key and value of each completed top-level member.
+        on_item (callable, optional): called with the key, index and value of each completed
+            element of a top-level array.
+    """
+    structural=re.compile(r'[\[\]{}",:]')
+    string_special=re.compile(r'["\\]')
+    partial_escape=re.compile(r'\\u[0-9a-fA-F]{0,3}$')
+    
+    def __init__(self, on_value=None, on_item=None):
+        self.on_value=on_value
+        self.on_item=on_item
+        self.text=""
+        self.pos=0 #next character to scan
+        self.stack=[] #open objects and arrays
+        self.in_string=False
+        self.string_start=None
+        self.begin=None #offsets of the top-level object
+        self.end=None
+        self.values={}
+        self.items={}
+        
+    @staticmethod
+    def decode(raw):
+        import json
+        try:
+            return json.loads(raw,strict=False)
+        except ValueError:
+            import json5
+            return json5.loads(raw)
+        
+    @property
+    def done(self):
+        return self.end is not None
+        
+    def feed(self, text):
+        """
+        Adds the next piece of the reply and reports any values it completes.
+        """
+        self.text+=text
+        while not self.done and self.pos<len(self.text):
+            if self.in_string:
+                match=self.string_special.search(self.text,self.pos)
+                if match is None:
+                    self.pos=len(self.text)
+                elif match.group()=='\\':
+                    if match.end()==len(self.text): #wait for the escaped character
+                        self.pos=match.start()
+                        break
+                    self.pos=match.end()+1
+                else:
+                    self.pos=match.end()
+                    self.in_string=False
+                    self.string_closed(match.start())
+                continue
+            match=self.structural.search(self.text,self.pos)
+            if match is None:
+                self.value_started(self.pos,len(self.text))
+                self.pos=len(self.text)
+                break
+            self.value_started(self.pos,match.start())
+            self.pos=match.end()
+            self.structure(match.group(),match.start())
+            
+    def value_started(self, start, stop):
+        # a number or literal begins somewhere between start and stop
+        if self.stack and self.stack[-1]['state']=='value' and self.stack[-1]['start'] is None:
+            skipped=self.text[start:stop]
+            if skipped.strip():
+                self.stack[-1]['start']=start+len(skipped)-len(skipped.lstrip())
+                
+    def structure(self, char, index):
+        level=self.stack[-1] if self.stack else None
+        if char in '{[':
+            if level is None:
+                if char=='[' or self.begin is not None: #only a top-level object is parsed
+                    return
+                self.begin=index
+            elif level['state']=='value' and level['start'] is None:
+                level['start']=index
+            self.stack.append({'kind':char,'state':'key' if char=='{' else 'value','start':None,
+                               'key':None,'key_start':index+1,'index':0,'emitted':False})
+        elif char=='"':
+            self.in_string=True
+            self.string_start=index
+            if level is not None and level['state']=='value' and level['start'] is None:
+                level['start']=index
+        elif level is None:
+            return
+        elif char==':':
+            if level['state']=='key': #json5 allows keys without double quotes
+                level['key']=self.text[level['key_start']:index].strip().strip("'")
+            level['state']='value'
+        elif char==',':
+            self.complete(index)
+            level.update({'state':'key' if level['kind']=='{' else 'value','start':None,'emitted':False,
+                          'key_start':index+1})
+            level['index']+=1
+        else: #closing bracket
+            self.complete(index)
+            self.stack.pop()
+            if not self.stack:
+                self.end=index+1
+            else:
+                self.complete(index+1) #the container was itself a value
+                
+    def string_closed(self, index):
+        level=self.stack[-1] if self.stack else None
+        if level is None:
+            return
+        if level['state']=='key':
+            level['key']=self.decode(self.text[self.string_start:index+1])
+            level['state']='colon'
+        elif level['start']==self.string_start:
+            self.complete(index+1)
+            
+    def complete(self, end):
+        # reports the member or element of the innermost container if it is one that is watched
+        level=self.stack[-1]
+        if level['start'] is None or level['emitted']:
+            return
+        depth=len(self.stack)
+        if depth>2 or (depth==2 and (level['kind']!='[' or self.stack[0]['state']!='value')):
+            return
+        level['emitted']=True
+        try:
+            value=self.decode(self.text[level['start']:end].strip())
+        except ValueError:
+            return #left for result() to report
+        if depth==1:
+            self.values[level['key']]=value
+            if self.on_value:
+                self.on_value(level['key'],value)
+        else:
+            key=self.stack[0]['key']
+            self.items.setdefault(key,[]).append(value)
+            if self.on_item:
+                self.on_item(key,level['index'],value)
+                
+    def partial(self, key):
+        """
+        Returns the value of top-level member key, the text so far of a string which is
+        still arriving or None if it has not started.
+        """
+        if key in self.values:
+            return self.values[key]
+        level=self.stack[0] if self.stack else None
+        if (not self.in_string or len(self.stack)!=1 or level['state']!='value' or level['key']!=key
+            or level['start']!=self.string_start):
+            return None
+        raw=self.partial_escape.sub('',self.text[self.string_start+1:self.pos])
+        try:
+            return self.decode('"'+raw+'"')
+        except ValueError:
+            return None
+        
+    def result(self):
+        """
+        Returns the whole decoded object. Text before and after the object, such as a
+        markdown code fence, is ignored.
+        """
+        if self.begin is not None and self.end is not None:
+            return self.decode(self.text[self.begin:self.end])
+        return self.decode(self.text)
+
+def revision_diff(old, new):
+    """
+    Compares two versions of an article.
+    
+    Returns:
+        tuple: the fraction of words which changed and the paragraphs of new which are not in old.
+    """
+    import difflib
+    
+    change=1-difflib.SequenceMatcher(None,old.split(),new.split()).ratio()
+    old_paragraphs={paragraph.strip() for paragraph in old.split('\n')}
+    changed=[paragraph.strip() for paragraph in new.split('\n')
+             if paragraph.strip() and paragraph.strip() not in old_paragraphs]
+    return change,changed
+
+def number_paragraphs(text):
+    """
+    Returns text with each non-blank line prefixed by its paragraph number in square brackets,
+    the numbering which apply_edit_script expects.
+    """
+    paragraphs=[line for line in text.split('\n') if line.strip()]
+    return "\n".join(f"[{number}] {paragraph}" for number,paragraph in enumerate(paragraphs,1))
+
+def apply_edit_script(text, edits):
+    """
+    Applies a list of edits to an article.
+    
+    Each edit is a dictionary with the 'paragraph' number as given by number_paragraphs,
+    the 'old' text in that paragraph and the 'new' text to replace it. An empty 'old' adds
+    'new' as a paragraph after the one numbered (0 for the start). Paragraph numbers
+    always refer to the article before any edits.
+    
+    Args:
+        text (str): the article.
+        edits (list): the edits.
+        
+    Returns:
+        tuple: the edited article and a list of the edits which could not be applied,
+               each with an 'error'. Nothing is changed if any edit fails.
+    """
+    lines=text.split('\n')
+    positions=[index for index,line in enumerate(lines) if line.strip()] #line of each paragraph
+    added={}
+    failed=[]
+    for edit in edits:
+        try:
+            number=int(edit.get('paragraph'))
+            old=edit.get('old') or ""
+            new=edit.get('new') or ""
+        except (AttributeError,TypeError,ValueError):
+            failed.append({"edit":edit,"error":"not an edit"})
+            continue
+        if not isinstance(old,str) or not isinstance(new,str):
+            failed.append({"edit":edit,"error":"old and new must be text"})
+        elif not old:
+            if 0<=number<=len(positions) and new.strip():
+                added.setdefault(number,[]).append(new.strip())
+            else:
+                failed.append({"edit":edit,"error":"no paragraph to add after"})
+        elif not 1<=number<=len(positions):
+            failed.append({"edit":edit,"error":"no such paragraph"})
+        elif old not in lines[positions[number-1]]:
+            failed.append({"edit":edit,"error":"old text is not in the paragraph"})
+        else:
+            line=positions[number-1]
+            lines[line]=lines[line].replace(old,new,1)
+    if failed:
+        return text,failed
+    for number in sorted(added,reverse=True): #from the end so earlier positions still hold
+        line=positions[number-1]+1 if number else 0
+        lines[line:line]=[part for paragraph in added[number] for part in ("",paragraph,"")]
+    return re.sub(r'\n{3,}','\n\n',"\n".join(lines)).strip('\n'),[]
+
+def format_significant_items(items):
+    """
+    Returns the outliner's list of significant items as the numbered text shown for review.
+    Text, such as a list already edited by the user, is returned unchanged.
+    """
+    if isinstance(items,str):
+        return items
+    return "\n".join(f"{item.get('number','')}. {item.get('description','')}\n    Explanation: {item.get('explanation','')}\n"
+                     for item in items)
+
+def article_preview(text, parser):
+    """
+    Returns readable markdown for a streamed writer reply: the title and the body so far
+    when the reply is a JSON article, the edits so far when it is an edit script and
+    otherwise the text unchanged.
+    
+    Args:
+        text (str): the reply so far.
+        parser (StreamingJSONParser): parser which has been fed the reply.
+    """
+    if not text.lstrip().startswith('{'):
+        return text
+    title=parser.partial('title')
+    body=parser.partial('body')
+    if title is None and body is None:
+        edits=[edit for edit in parser.items.get('edits',[]) if isinstance(edit,dict)]
+        if not text.lstrip('{ \n').startswith('"edits"') and not edits:
+            return text
+        lines=[f"*Revising the article: {len(edits)} edit{'' if len(edits)==1 else 's'} so far...*"]
+        for edit in edits:
+            old,new=edit.get('old') or "",edit.get('new') or ""
+            if not old:
+                lines.append(f"- paragraph {edit.get('paragraph')}: add \"{new}\"")
+            elif not new:
+                lines.append(f"- paragraph {edit.get('paragraph')}: remove \"{old}\"")
+            else:
+                lines.append(f"- paragraph {edit.get('paragraph')}: \"{old}\" → \"{new}\"")
+        return "\n".join(lines)
+    body=body or ""
+    return f"# {title}\n\n{body}" if isinstance(title,str) and title else body
 
 def replace_special_characters(text):
     import re
@@ -112,6 +615,20 @@ def markdown_to_html(markdown_text, scrub_text=True,title=None, date=None, smart
         markdown_text=replace_special_characters(markdown_text)
     html_content = markdown.markdown(markdown_text)
     
+    return html_page(html_content,title=title,date=date,smart_transcript=smart_transcript)
+
+def html_page(html_content, title=None, date=None, smart_transcript=None, head_extra="", body_extra=""):
+    """
+    Wraps html_content in the self-contained page used for articles.
+    
+    Args:
+        html_content (str): the article as html.
+        title (str, optional): The title of the HTML document. Defaults to None.
+        date (str, optional): The date for the document in 'YYYY-MM-DD' format. Defaults to None.
+        smart_transcript (str, optional): URL to the smart transcript. Defaults to None.
+        head_extra (str, optional): html added at the end of the head.
+        body_extra (str, optional): html added at the end of the body.
+    """
     # Format the title and date
     title_html = f"<h1>{title}</h1>\n" if title else ""
     date_html = f"<p class=\"date\">{date}</p>\n" if date else ""
@@ -169,13 +686,13 @@ def markdown_to_html(markdown_text, scrub_text=True,title=None, date=None, smart
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>{title if title else 'Document'}</title>
-        {css}
+        {css}{head_extra}
     </head>
     <body>
         {title_html}
         {date_html}
         {html_content}
-        {smart_transcript_html}
+        {smart_transcript_html}{body_extra}
     </body>
     </html>
     """ 
@@ -194,31 +711,403 @@ def generate_html_from_html(input_html_filepath, video_filepath, pk1_filepath, o
         
     return generate_html_from_html_data(article_html, video_filepath, deepgram_return, output_html_filepath)
 
-def generate_html_from_html_data(article_html, video_filepath, deepgram_return, output_html_filepath=None):
-    import re
-    from bs4 import BeautifulSoup
-    from string import punctuation
+def strip_punctuation(word):
+    return word.strip(string.punctuation).lower()
 
-    word_objects=deepgram_return['channels'][0]['alternatives'][0]['words']
+class FuzzyAligner:
+    """
+    Finds the transcript span which best matches a quote even when the quote is not verbatim.
     
-    def strip_punctuation(word):
-        return word.strip(punctuation).lower()
+    Transcript and quote words are encoded as integer arrays and scored with a
+    Smith-Waterman local alignment vectorized with NumPy. Only bands of the
+    transcript dense in quote words are aligned, so a lookup in a 50k word
+    transcript takes a few milliseconds.
     
-    def find_clip_for_quote(quote):
+    Args:
+        tokens (list): normalized transcript words.
+    """
+    match=2
+    mismatch=-1
+    gap=1
+    
+    def __init__(self, tokens):
+        import numpy as np
+        
+        self.vocabulary={}
+        self.ids=np.array([self.vocabulary.setdefault(token,len(self.vocabulary)) for token in tokens],dtype=np.int32)
+        
+    def encode(self, words):
+        import numpy as np
+        # words missing from the transcript get distinct negative ids so they never match
+        return np.array([self.vocabulary.get(word,-1-i) for i,word in enumerate(words)],dtype=np.int32)
+    
+    def candidate_bands(self, quote_ids, max_bands=8):
+        """
+        Returns (start, stop) ranges of the transcript worth aligning against the quote.
+        """
+        import numpy as np
+        
+        length=len(quote_ids)
+        hits=np.isin(self.ids,quote_ids[quote_ids>=0])
+        if not hits.any():
+            return []
+        counts=np.concatenate(([0],np.cumsum(hits,dtype=np.int32)))
+        window=min(length,len(self.ids))
+        density=counts[window:]-counts[:-window] #quote words in each window
+        threshold=max(1,int(density.max())//2)
+        candidates=np.flatnonzero(density>=threshold)
+        candidates=candidates[np.argsort(-density[candidates],kind='stable')]
+        bands=[]
+        for start in candidates:
+            if len(bands)>=max_bands:
+                break
+            if any(low<=start<high for low,high in bands):
+                continue
+            bands.append((max(0,int(start)-length),min(len(self.ids),int(start)+2*length)))
+        bands.sort()
+        merged=[]
+        for low,high in bands:
+            if merged and low<=merged[-1][1]:
+                merged[-1]=(merged[-1][0],max(merged[-1][1],high))
+            else:
+                merged.append((low,high))
+        return merged
+    
+    def align_band(self, quote_ids, low, high):
+        import numpy as np
+        
+        region=self.ids[low:high]
+        rows=len(quote_ids)
+        columns=np.arange(len(region)+1,dtype=np.int32)*self.gap
+        scores=np.zeros((rows+1,len(region)+1),dtype=np.int32)
+        for i in range(1,rows+1):
+            previous=scores[i-1]
+            substitution=np.where(region==quote_ids[i-1],self.match,self.mismatch)
+            best=np.maximum(previous[:-1]+substitution,previous[1:]-self.gap)
+            row=scores[i]
+            row[1:]=np.maximum(best,0)
+            # a gap in the quote can extend across the row; resolve it with a running maximum
+            scores[i]=np.maximum.accumulate(row+columns)-columns
+        i,j=np.unravel_index(np.argmax(scores),scores.shape)
+        score=int(scores[i,j])
+        if score<=0:
+            return None
+        end=j
+        while i>0 and j>0 and scores[i,j]>0:
+            substitution=self.match if region[j-1]==quote_ids[i-1] else self.mismatch
+            if scores[i,j]==scores[i-1,j-1]+substitution:
+                i-=1
+                j-=1
+            elif scores[i,j]==scores[i-1,j]-self.gap:
+                i-=1
+            else:
+                j-=1
+        return {"start":low+int(j),"end":low+int(end),"score":score}
+        
+    def align(self, words, min_ratio=0.0):
+        """
+        Aligns the normalized quote words against the transcript.
+        
+        Returns:
+            dict: 'start' and 'end' (exclusive) word positions of the best span, its 'score'
+                  and 'ratio', the score as a fraction of a perfect match, or None if
+                  no span reaches min_ratio.
+        """
+        if not words or not len(self.ids):
+            return None
+        quote_ids=self.encode(words)
+        best=None
+        for low,high in self.candidate_bands(quote_ids):
+            result=self.align_band(quote_ids,low,high)
+            if result and (best is None or result['score']>best['score']):
+                best=result
+        if best is None:
+            return None
+        best['ratio']=best['score']/(self.match*len(words))
+        return best if best['ratio']>=min_ratio else None
+
+class WordIndex:
+    """
+    Alignment index over the timed words of a transcript.
+    
+    The transcript words are normalized once and the positions of every run of
+    `ngram` words are hashed, so looking up a quote costs about its own length
+    instead of a scan of the whole transcript. Build one per meeting and reuse it
+    for every quote.
+    
+    Args:
+        words (list): transcript words as returned by Deepgram's 'word' field.
+        starts (list): start time in seconds of each word.
+        ends (list): end time in seconds of each word.
+        punctuated (list, optional): display form of each word. Defaults to words.
+        ngram (int, optional): number of leading quote words used as hash key.
+        tokens (list, optional): words already normalized with strip_punctuation.
+    """
+    def __init__(self, words, starts, ends, punctuated=None, ngram=3, tokens=None):
+        self.words=punctuated if punctuated is not None else words
+        self.starts=starts
+        self.ends=ends
+        self.ngram=ngram
+        self.tokens=tokens if tokens is not None else [strip_punctuation(word) for word in words]
+        self.unigrams={}
+        self.ngrams={}
+        tokens=self.tokens
+        for i,token in enumerate(tokens):
+            self.unigrams.setdefault(token,[]).append(i)
+        for i in range(len(tokens)-ngram+1):
+            self.ngrams.setdefault(tuple(tokens[i:i+ngram]),[]).append(i)
+            
+    @classmethod
+    def from_deepgram(cls, deepgram_return, ngram=3):
+        word_objects=deepgram_return['channels'][0]['alternatives'][0]['words']
+        return cls([word['word'] for word in word_objects],
+                   [word['start'] for word in word_objects],
+                   [word['end'] for word in word_objects],
+                   punctuated=[word.get('punctuated_word',word['word']) for word in word_objects],
+                   ngram=ngram)
+    
+    @classmethod
+    def from_columnar(cls, source, ngram=3):
+        """
+        Builds the index from the compact format written by save_word_columns.
+        
+        Args:
+            source (str or bytes): path of the file, which is memory-mapped, or its content.
+        """
+        columns=load_word_columns(source)
+        vocabulary=columns['vocabulary']
+        normalized=[strip_punctuation(word) for word in vocabulary] #once per distinct word
+        word_ids=columns['word_ids'].tolist()
+        return cls(None,columns['starts'],columns['ends'],
+                   punctuated=[vocabulary[i] for i in columns['display_ids'].tolist()],
+                   ngram=ngram,tokens=[normalized[i] for i in word_ids])
+    
+    def time(self, seconds):
+        return round(float(seconds),3)
+    
+    def __len__(self):
+        return len(self.tokens)
+    
+    @staticmethod
+    def quote_tokens(quote):
         # Replace hyphens with spaces and split into words
-        words = [strip_punctuation(word) for word in quote.replace('-', ' ').split()]
-        matches = []
-        for i in range(len(word_objects) - len(words) + 1):
-            if all(strip_punctuation(word_objects[i + j]['word']) == words[j] for j in range(len(words))):
-                matches.append((word_objects[i]['start'], word_objects[i + len(words) - 1]['end']))
-        return matches[0] if matches else None
+        return [strip_punctuation(word) for word in quote.replace('-', ' ').split()]
+            
+    def find_positions(self, quote):
+        """
+        Returns the index of the first word of every place the quote occurs in the transcript.
+        """
+        words=self.quote_tokens(quote)
+        if not words:
+            return []
+        if len(words)>=self.ngram:
+            candidates=self.ngrams.get(tuple(words[:self.ngram]),[])
+        else:
+            candidates=self.unigrams.get(words[0],[])
+        tokens=self.tokens
+        length=len(words)
+        return [i for i in candidates if tokens[i:i+length]==words]
+    
+    def find(self, quote):
+        """
+        Returns a list of (start, end) times in seconds for every occurrence of the quote.
+        """
+        length=len(self.quote_tokens(quote))
+        return [(self.time(self.starts[i]),self.time(self.ends[i+length-1])) for i in self.find_positions(quote)]
+    
+    def fuzzy_find(self, quote, min_ratio=0.6):
+        """
+        Finds the span of the transcript closest to a quote which may not be verbatim.
+        
+        Returns:
+            dict: 'start' and 'end' times in seconds, verbatim 'text' of the span, its
+                  alignment 'score' and 'ratio' and word 'positions', or None if nothing
+                  is close enough.
+        """
+        if getattr(self,'aligner',None) is None:
+            self.aligner=FuzzyAligner(self.tokens)
+        words=[word for word in self.quote_tokens(quote) if word]
+        result=self.aligner.align(words,min_ratio=min_ratio)
+        if result is None:
+            return None
+        first,last=result['start'],result['end']
+        return {"start":self.time(self.starts[first]),"end":self.time(self.ends[last-1]),
+                "text":" ".join(self.words[first:last]),
+                "score":result['score'],"ratio":result['ratio'],"positions":(first,last)}
 
-    # Parse the HTML content
-    soup = BeautifulSoup(article_html, 'html.parser')
+WORD_COLUMNS_MAGIC=b"MMWORDS1"
 
-    # Set the maximum column width and video player style
-    style_tag = soup.new_tag('style')
-    style_tag.string = """
+def deepgram_to_columns(deepgram_return):
+    """
+    Encodes the words of a Deepgram response in a compact columnar format.
+    
+    The file is a 24 byte header (magic, word count, vocabulary size in bytes)
+    followed by int32 word ids, int32 punctuated word ids, float32 start times,
+    float32 end times and the interned vocabulary as newline separated utf-8.
+    Everything else in the response is dropped.
+    
+    Returns:
+        bytes: the encoded words.
+    """
+    import numpy as np
+    import struct
+    
+    word_objects=deepgram_return['channels'][0]['alternatives'][0]['words']
+    vocabulary={}
+    def intern(word):
+        return vocabulary.setdefault(word.replace("\n"," "),len(vocabulary))
+    word_ids=np.array([intern(word['word']) for word in word_objects],dtype='<i4')
+    display_ids=np.array([intern(word.get('punctuated_word',word['word'])) for word in word_objects],dtype='<i4')
+    starts=np.array([word['start'] for word in word_objects],dtype='<f4')
+    ends=np.array([word['end'] for word in word_objects],dtype='<f4')
+    vocabulary_bytes="\n".join(vocabulary).encode('utf-8')
+    header=WORD_COLUMNS_MAGIC+struct.pack('<QQ',len(word_objects),len(vocabulary_bytes))
+    return b"".join([header,word_ids.tobytes(),display_ids.tobytes(),starts.tobytes(),ends.tobytes(),vocabulary_bytes])
+
+def save_word_columns(deepgram_return, path):
+    with open(path,'wb') as columns_file:
+        columns_file.write(deepgram_to_columns(deepgram_return))
+        
+def convert_deepgram_pickle(pickle_path, output_path):
+    """
+    Converts a pickled Deepgram response to the columnar format read by WordIndex.from_columnar.
+    """
+    import pickle
+    
+    with open(pickle_path,'rb') as pk1_file:
+        save_word_columns(pickle.load(pk1_file),output_path)
+        
+def load_word_columns(source):
+    """
+    Reads the columnar format written by save_word_columns without copying the arrays.
+    
+    Args:
+        source (str or bytes): path of the file, which is memory-mapped, or its content.
+        
+    Returns:
+        dict: 'word_ids', 'display_ids', 'starts' and 'ends' numpy arrays and the 'vocabulary' list.
+    """
+    import numpy as np
+    import struct
+    
+    if isinstance(source,str):
+        buffer=np.memmap(source,dtype=np.uint8,mode='r')
+    else:
+        buffer=np.frombuffer(source,dtype=np.uint8)
+    if bytes(buffer[:8])!=WORD_COLUMNS_MAGIC:
+        raise ValueError("not a word columns file")
+    count,vocabulary_size=struct.unpack('<QQ',bytes(buffer[8:24]))
+    offset=24
+    columns={}
+    for name,dtype in (('word_ids','<i4'),('display_ids','<i4'),('starts','<f4'),('ends','<f4')):
+        columns[name]=np.frombuffer(buffer,dtype=dtype,count=count,offset=offset)
+        offset+=4*count
+    vocabulary=bytes(buffer[offset:offset+vocabulary_size]).decode('utf-8')
+    columns['vocabulary']=vocabulary.split("\n") if count else []
+    return columns
+
+def load_word_index(data):
+    """
+    Builds a WordIndex from downloaded timing data, either the columnar format or a legacy
+    pickled Deepgram response.
+    """
+    import pickle
+    
+    if data[:len(WORD_COLUMNS_MAGIC)]==WORD_COLUMNS_MAGIC:
+        return WordIndex.from_columnar(data)
+    return WordIndex.from_deepgram(pickle.loads(data))
+
+_prefetch_lock=threading.Lock()
+_prefetch_executor=None
+_prefetched=collections.OrderedDict() #key -> Future, oldest first
+PREFETCH_MAX_ENTRIES=8 #prefetches kept for sessions which have not collected them yet
+
+def fetch_word_index(url):
+    data=load_binary_file_from_url(url)
+    if data is None:
+        raise ValueError(f"could not download timing data from {url}")
+    return load_word_index(data)
+
+def check_hls_manifest(url):
+    """
+    Returns True if url serves an HLS playlist.
+    """
+    try:
+        response=cached_get(url)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"could not fetch video manifest {url}: {e}")
+        return False
+    return response.content.lstrip().startswith(b"#EXTM3U")
+
+def prefetch(key, function, *args):
+    """
+    Starts function(*args) on a background thread unless it was already started for key.
+    At most PREFETCH_MAX_ENTRIES results are kept. Beyond that the oldest are dropped,
+    and cancelled if they have not started, so abandoned sessions do not hold them.
+    
+    Returns:
+        concurrent.futures.Future: the pending result.
+    """
+    global _prefetch_executor
+    from concurrent.futures import ThreadPoolExecutor
+    
+    with _prefetch_lock:
+        if key in _prefetched:
+            _prefetched.move_to_end(key)
+            return _prefetched[key]
+        if _prefetch_executor is None:
+            _prefetch_executor=ThreadPoolExecutor(max_workers=2,thread_name_prefix='prefetch')
+        future=_prefetched[key]=_prefetch_executor.submit(function,*args)
+        while len(_prefetched)>PREFETCH_MAX_ENTRIES:
+            _,evicted=_prefetched.popitem(last=False)
+            evicted.cancel()
+        return future
+
+def prefetch_word_index(url, video=None):
+    """
+    Starts downloading, parsing and indexing the timing data at url, and checking the
+    video manifest if it is HLS, while the caller gets on with other work.
+    """
+    if video and video.lower().endswith('.m3u8'):
+        prefetch(('manifest',video),check_hls_manifest,video)
+    return prefetch(('words',url),fetch_word_index,url)
+
+def ready_word_index(url):
+    """
+    Returns the prefetched WordIndex for url if it is ready, otherwise None without waiting.
+    """
+    with _prefetch_lock:
+        future=_prefetched.get(('words',url))
+    if future is None or not future.done() or future.exception() is not None:
+        return None
+    return future.result()
+
+def get_word_index(url, video=None, timeout=None):
+    """
+    Returns the WordIndex for the timing data at url, waiting for a prefetch if one is
+    running and fetching it now if none was started or the prefetch failed.
+    """
+    if video and video.lower().endswith('.m3u8'):
+        with _prefetch_lock:
+            manifest=_prefetched.pop(('manifest',video),None)
+        if manifest is not None and not manifest.result(timeout):
+            print(f"warning: {video} does not look like an HLS playlist")
+    future=prefetch_word_index(url)
+    try:
+        return future.result(timeout)
+    except Exception as e:
+        if not future.done(): #still running after timeout
+            raise
+        print(f"prefetch of {url} failed, fetching again: {e}")
+        return fetch_word_index(url)
+    finally:
+        with _prefetch_lock:
+            if _prefetched.get(('words',url)) is future:
+                del _prefetched[('words',url)]
+
+# Set the maximum column width and video player style
+CLIP_CSS = """
     body {
         max-width: 7.5in;
         margin: auto;
@@ -230,18 +1119,11 @@ def generate_html_from_html_data(article_html, video_filepath, deepgram_return,
         margin-bottom: 1em;
     }
     """
-    soup.head.append(style_tag)
 
-    # Determine if the file is an mp4 or m3u8
-    is_m3u8 = video_filepath.lower().endswith('.m3u8')
-    if is_m3u8:
-        # Add hls.js script to the HTML
-        script_tag = soup.new_tag('script', src='https://cdn.jsdelivr.net/npm/hls.js@latest')
-        soup.head.append(script_tag)
+HLS_SCRIPT_URL = 'https://cdn.jsdelivr.net/npm/hls.js@latest'
 
-        # Add custom script to initialize hls.js for each m3u8 video
-        custom_script_tag = soup.new_tag('script')
-        custom_script_tag.string = """
+# initializes hls.js for each m3u8 video
+HLS_INIT_SCRIPT = """
         document.addEventListener('DOMContentLoaded', function () {
             document.querySelectorAll('video[data-hls]').forEach(function (video) {
                 var startTime = parseFloat(video.getAttribute('data-start'));
@@ -275,6 +1157,170 @@ def generate_html_from_html_data(article_html, video_filepath, deepgram_return,
             });
         });
         """
+
+# quotes become buttons which play their clip in one shared player
+SHARED_PLAYER_CSS = """
+    .clip {
+        cursor: pointer;
+        border-bottom: 1px dotted #0056b3;
+    }
+    .clip::after {
+        content: " \\25B6";
+        color: #0056b3;
+        font-size: 0.8em;
+    }
+    #clip-player {
+        display: none;
+        position: sticky;
+        top: 0;
+        max-height: 40vh;
+        background: #000;
+    }
+    #clip-player.active {
+        display: block;
+    }
+    """
+
+# attaches the video source, and hls.js if needed, on the first click so nothing is fetched on page load.
+# play() is called inside the click handler itself, which starts loading and satisfies iOS's user gesture rule
+SHARED_PLAYER_SCRIPT = """
+        (function () {
+            var player = document.getElementById('clip-player');
+            var source = player.getAttribute('data-src');
+            var hlsScript = player.getAttribute('data-hls');
+            var ready = null;
+            var endTime = null;
+
+            function load() {
+                if (ready) {
+                    return ready;
+                }
+                ready = new Promise(function (resolve) {
+                    if (!hlsScript || player.canPlayType('application/vnd.apple.mpegurl')) {
+                        player.addEventListener('loadedmetadata', resolve, {once: true});
+                        player.preload = 'metadata'; // with preload="none" metadata is never fetched
+                        player.src = source;
+                        player.load();
+                        return;
+                    }
+                    var script = document.createElement('script');
+                    script.src = hlsScript;
+                    script.onload = function () {
+                        var hls = new Hls();
+                        hls.on(Hls.Events.MANIFEST_PARSED, resolve);
+                        hls.loadSource(source);
+                        hls.attachMedia(player);
+                    };
+                    document.head.appendChild(script);
+                });
+                return ready;
+            }
+
+            player.addEventListener('timeupdate', function () {
+                if (endTime !== null && player.currentTime >= endTime) {
+                    player.pause();
+                    endTime = null;
+                }
+            });
+
+            function play(clip) {
+                player.classList.add('active');
+                var loaded = load();
+                var started = player.play(); // while still handling the click
+                if (started) {
+                    started.catch(function () {}); // hls.js attaches the source later
+                }
+                loaded.then(function () {
+                    endTime = parseFloat(clip.getAttribute('data-end'));
+                    player.currentTime = parseFloat(clip.getAttribute('data-start'));
+                    player.play();
+                });
+            }
+
+            document.querySelectorAll('.clip').forEach(function (clip) {
+                clip.addEventListener('click', function () {
+                    play(clip);
+                });
+                clip.addEventListener('keydown', function (event) {
+                    if (event.key === 'Enter' || event.key === ' ') {
+                        event.preventDefault();
+                        play(clip);
+                    }
+                });
+            });
+        })();
+        """
+
+def clip_finder(word_index, quote_records=None, fuzzy_ratio=0.8):
+    """
+    Returns a function which gives the (start, end) times of the clip for a quote or None.
+    
+    Clip times stored in quote_records are used first, then exact matches in word_index
+    and finally, unless fuzzy_ratio is None, the closest span if it is close enough.
+    """
+    known_clips={quote_key(record['text']):(record['clip_start'],record['clip_end'])
+                 for record in quote_records or [] if record.get('clip_start') is not None}
+    
+    def find_clip_for_quote(quote):
+        if quote_key(quote) in known_clips:
+            return known_clips[quote_key(quote)]
+        if word_index is None:
+            return None
+        matches=word_index.find(quote)
+        if matches:
+            return matches[0]
+        if fuzzy_ratio is not None:
+            nearest=word_index.fuzzy_find(quote,min_ratio=fuzzy_ratio)
+            if nearest:
+                return (nearest['start'],nearest['end'])
+        return None
+    return find_clip_for_quote
+
+def generate_html_from_html_data(article_html, video_filepath, deepgram_return, output_html_filepath=None, word_index=None,
+                                 fuzzy_ratio=0.8, quote_records=None):
+    """
+    Inserts a video clip before each quote in article_html which can be found in the timed transcript.
+    
+    Args:
+        article_html (str): the article as a complete html page.
+        video_filepath (str): url of the meeting video; .m3u8 or anything playable by a <video> tag.
+        deepgram_return (dict): Deepgram response for the meeting. Ignored if word_index is given.
+        output_html_filepath (str, optional): where to write the result.
+        word_index (WordIndex, optional): prebuilt index for the meeting.
+        fuzzy_ratio (float, optional): minimum alignment ratio for using the closest span when
+            a quote is not verbatim. None for exact matches only.
+        quote_records (list, optional): records from verify_quotes. Quotes with clip times
+            there are not searched for again.
+        
+    Returns:
+        tuple: the html string and a list of quotes for which no clip was found.
+    """
+    import re
+    from bs4 import BeautifulSoup
+
+    if word_index is None:
+        word_index=WordIndex.from_deepgram(deepgram_return)
+    
+    find_clip_for_quote=clip_finder(word_index,quote_records,fuzzy_ratio)
+
+    # Parse the HTML content
+    soup = BeautifulSoup(article_html, 'html.parser')
+
+    # Set the maximum column width and video player style
+    style_tag = soup.new_tag('style')
+    style_tag.string = CLIP_CSS
+    soup.head.append(style_tag)
+
+    # Determine if the file is an mp4 or m3u8
+    is_m3u8 = video_filepath.lower().endswith('.m3u8')
+    if is_m3u8:
+        # Add hls.js script to the HTML
+        script_tag = soup.new_tag('script', src=HLS_SCRIPT_URL)
+        soup.head.append(script_tag)
+
+        # Add custom script to initialize hls.js for each m3u8 video
+        custom_script_tag = soup.new_tag('script')
+        custom_script_tag.string = HLS_INIT_SCRIPT
         soup.body.append(custom_script_tag)
 
     # Find all quotes in the HTML
@@ -328,47 +1374,566 @@ def generate_html_from_html_data(article_html, video_filepath, deepgram_return,
             print(f'HTML file generated: {output_html_filepath}')
     return str(soup), not_found
 
-def extract_text(content,content_type):
+def pdf_page_texts(source, start, stop):
+    """
+    Returns the text of pages start to stop-1 of a pdf given as a path or bytes.
+    Runs in worker processes for iter_pdf_pages.
+    """
+    import fitz
+    
+    with (fitz.open(source) if isinstance(source,str) else fitz.open(stream=source, filetype="pdf")) as doc:
+        return [doc[i].get_text() for i in range(start,stop)]
+
+def iter_pdf_pages(source, workers=None, chunk_pages=16, parallel_min_pages=64):
+    """
+    Yields the text of each page of a pdf in page order.
+    
+    Large documents are split into ranges of chunk_pages pages which are extracted
+    by a pool of processes. Only a few ranges are in flight at once so pages are
+    yielded as soon as they are ready without holding the whole document's text.
+    
+    Args:
+        source (str or bytes): path of the pdf or its content.
+        workers (int, optional): number of processes. Defaults to the number of cpus. 1 extracts serially.
+        chunk_pages (int, optional): minimum pages per task.
+        parallel_min_pages (int, optional): documents with fewer pages are extracted serially.
+    """
+    import fitz
+    import tempfile
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    
+    workers=workers or os.cpu_count() or 1
+    with (fitz.open(source) if isinstance(source,str) else fitz.open(stream=source, filetype="pdf")) as doc:
+        page_count=doc.page_count
+        if workers==1 or page_count<parallel_min_pages:
+            for page in doc:
+                yield page.get_text()
+            return
+    spooled=None
+    if not isinstance(source,str): #give workers a path rather than copying the bytes to each
+        with tempfile.NamedTemporaryFile(suffix='.pdf',delete=False) as spool:
+            spool.write(source)
+        source=spooled=spool.name
+    # every task reopens the document so keep the number of tasks modest
+    chunk_pages=max(chunk_pages,-(-page_count//(8*workers)))
+    ranges=iter([(start,min(start+chunk_pages,page_count)) for start in range(0,page_count,chunk_pages)])
+    pending=deque()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for start,stop in ranges:
+                pending.append(executor.submit(pdf_page_texts,source,start,stop))
+                if len(pending)>=2*workers:
+                    break
+            while pending:
+                texts=pending.popleft().result()
+                next_range=next(ranges,None)
+                if next_range:
+                    pending.append(executor.submit(pdf_page_texts,source,*next_range))
+                yield from texts
+    finally:
+        for future in pending:
+            future.cancel()
+        if spooled:
+            os.remove(spooled)
+            
+def extract_pdf_text(source, workers=None, joined=True):
+    """
+    Returns the text of a pdf as one string, or as a list of page texts if joined is False.
+    
+    Args:
+        source (str or bytes): path of the pdf or its content.
+        workers (int, optional): see iter_pdf_pages.
+    """
+    pages=iter_pdf_pages(source,workers=workers)
+    return "\n".join(pages) if joined else list(pages)
+
+def benchmark_pdf_extraction(path, worker_counts=(1,2,4,8), repeats=3):
+    """
+    Prints the throughput in pages per second of serial and parallel extraction of a pdf.
+    
+    Example: python -c "import mytools; mytools.benchmark_pdf_extraction('packet.pdf')"
+    """
+    import time
+    
+    for workers in worker_counts:
+        best=None
+        for _ in range(repeats):
+            started=time.perf_counter()
+            pages=sum(1 for _ in iter_pdf_pages(path,workers=workers,parallel_min_pages=0))
+            elapsed=time.perf_counter()-started
+            best=elapsed if best is None else min(best,elapsed)
+        print(f"{workers} worker{'s' if workers>1 else ''}: {pages} pages in {best:.2f}s, {pages/best:.1f} pages/s")
+
+TEXT_CACHE_DIR=os.getenv("MM_TEXT_CACHE_DIR",os.path.join(os.path.expanduser("~"),".cache","mmtest","text"))
+TEXT_CACHE_MAX_BYTES=int(os.getenv("MM_TEXT_CACHE_MAX_BYTES",str(512*1024*1024)))
+EXTRACTOR_VERSION="2" #change whenever extract_text would return something different for the same input
+
+class TextCache:
+    """
+    Persistent cache of text extracted from documents.
+    
+    Entries are keyed by the SHA-256 of the raw bytes plus the content type and
+    EXTRACTOR_VERSION, so a document is parsed once no matter where it came from.
+    When the cache grows past max_bytes the least recently used entries are removed.
+    
+    Args:
+        directory (str, optional): where entries are stored. Defaults to TEXT_CACHE_DIR.
+        max_bytes (int, optional): size limit of the cache. Defaults to TEXT_CACHE_MAX_BYTES.
+    """
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory=directory or TEXT_CACHE_DIR
+        self.max_bytes=TEXT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        
+    @staticmethod
+    def key(content, content_type):
+        import hashlib
+        
+        digest=hashlib.sha256()
+        digest.update(content.encode('utf-8') if isinstance(content,str) else content)
+        digest.update(f"\0{content_type}\0{EXTRACTOR_VERSION}".encode('utf-8'))
+        return digest.hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.directory,key+'.json')
+    
+    def get(self, key):
+        import json
+        
+        path=self.path(key)
+        try:
+            with open(path,'r',encoding='utf-8') as cache_file:
+                value=json.load(cache_file)
+            os.utime(path) #mark as recently used
+            return value
+        except (OSError,ValueError):
+            return None
+        
+    def put(self, key, value):
+        import json
+        
+        try:
+            os.makedirs(self.directory,exist_ok=True)
+            _replace_file(self.path(key),json.dumps(value).encode('utf-8'))
+            self.evict()
+        except OSError as e:
+            print(f"could not cache extracted text: {e}")
+            
+    def evict(self):
+        import time
+        
+        entries=[]
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'): #left by a writer which died
+                try:
+                    if time.time()-entry.stat().st_mtime>60:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.name.endswith('.json'):
+                stat=entry.stat()
+                entries.append((stat.st_mtime,stat.st_size,entry.path))
+        total=sum(size for _,size,_ in entries)
+        for _,size,path in sorted(entries):
+            if total<=self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total-=size
+            except OSError:
+                pass
+
+@functools.lru_cache(maxsize=1)
+def get_text_cache():
+    return TextCache()
+
+def extract_text(content,content_type,use_cache=True,path=None):
+    """
+    Returns the text of a document.
+    
+    Args:
+        content (bytes, str or buffer): the document, for example an mmap of it.
+        content_type (str): 'html', 'docx', 'pdf' or 'txt'.
+        use_cache (bool, optional): look up and store the result in the persistent TextCache.
+        path (str, optional): the file content was mapped from. Parsers which can
+            open the file themselves are given the path instead of a copy of content.
+    """
+    if not use_cache:
+        return extract_text_uncached(content,content_type,path)
+    cache=get_text_cache()
+    key=cache.key(content,content_type)
+    text=cache.get(key)
+    if text is None:
+        text=extract_text_uncached(content,content_type,path)
+        cache.put(key,text)
+    return text
+
+def extract_text_uncached(content,content_type,path=None):
     from bs4 import BeautifulSoup
     from docx import Document
-    import fitz
     import io
     
     if 'html' in content_type:
         return BeautifulSoup(content, 'html.parser').get_text()
     elif 'docx' == content_type:
-        return "\n".join([paragraph.text for paragraph in Document(io.BytesIO(content)).paragraphs])
+        return "\n".join([paragraph.text for paragraph in Document(path or io.BytesIO(content)).paragraphs])
     elif 'pdf' == content_type:
-        text = []
-        with fitz.open(stream=content, filetype="pdf") as doc:
-            for page in doc:
-                text.append(page.get_text())
-        return text
+        return extract_pdf_text(path or bytes(content))
     elif 'txt' == content_type:
-        return content.decode('utf-8',errors='replace')
+        return content if isinstance(content,str) else str(content,'utf-8',errors='replace')
     else:
         raise ValueError("Unsupported file type or content")
         
-def load_text_from_path(path):
-    with open(path, 'rb') as file:
-        content = file.read()
+def load_text_from_path(path,use_cache=True):
+    """
+    Returns the text of a local document.
+    
+    The file is memory-mapped rather than read so it is hashed for the TextCache
+    and handed to the parsers without an intermediate copy.
+    """
+    import mmap
+    
     content_type=path.split(".")[-1]
-    return extract_text(content, content_type)
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size==0: #empty files can't be mapped
+            return extract_text(b"",content_type,use_cache)
+        with mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ) as content:
+            return extract_text(content,content_type,use_cache,path=path)
 
-def load_text_from_url(url,timeout=10):
-    import requests
-    import mimetypes
-    from selenium import webdriver
-    from selenium.webdriver.firefox.options import Options
-    from selenium.webdriver.firefox.service import Service
+@functools.lru_cache(maxsize=1)
+def geckodriver_path():
+    """
+    Returns the path of the geckodriver binary, resolving (and if necessary downloading) it once per process.
+    """
     from webdriver_manager.firefox import GeckoDriverManager
+    return GeckoDriverManager().install()
+
+class BrowserPool:
+    """
+    Bounded pool of long-lived headless Firefox drivers.
+    
+    Drivers are reused across requests, checked before each use, replaced after
+    max_pages page loads and quit when the process exits.
+    
+    Args:
+        max_size (int, optional): most drivers alive at once.
+        max_pages (int, optional): pages a driver loads before it is replaced.
+        acquire_timeout (float, optional): seconds to wait for a free driver.
+    """
+    def __init__(self, max_size=2, max_pages=50, acquire_timeout=60):
+        import queue
+        import threading
+        
+        self.max_pages=max_pages
+        self.acquire_timeout=acquire_timeout
+        self.slots=threading.BoundedSemaphore(max_size)
+        self.idle=queue.LifoQueue()
+        self.pages={}
+        self.lock=threading.Lock()
+        self.closed=False
+        
+    def new_driver(self):
+        from selenium import webdriver
+        from selenium.webdriver.firefox.options import Options
+        from selenium.webdriver.firefox.service import Service
+        
+        firefoxOptions = Options()
+        firefoxOptions.add_argument("--headless")
+        driver = webdriver.Firefox(
+            options=firefoxOptions,
+            service=Service(geckodriver_path()),
+        )
+        with self.lock:
+            self.pages[driver]=0
+        return driver
+    
+    def quit_driver(self, driver):
+        with self.lock:
+            self.pages.pop(driver,None)
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f"error closing browser: {e}")
+            
+    @staticmethod
+    def is_healthy(driver):
+        try:
+            driver.execute_script("return 1")
+            return True
+        except Exception:
+            return False
+    
+    def acquire(self, timeout=None):
+        import queue
+        
+        if self.closed:
+            raise RuntimeError("browser pool is closed")
+        timeout=self.acquire_timeout if timeout is None else timeout
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError(f"no browser available after {timeout} seconds")
+        try:
+            while True:
+                try:
+                    driver=self.idle.get_nowait()
+                except queue.Empty:
+                    return self.new_driver()
+                if self.is_healthy(driver):
+                    return driver
+                self.quit_driver(driver)
+        except BaseException:
+            self.slots.release()
+            raise
+            
+    def release(self, driver, discard=False):
+        with self.lock:
+            self.pages[driver]=self.pages.get(driver,0)+1
+            worn_out=self.pages[driver]>=self.max_pages
+        if discard or worn_out or self.closed:
+            self.quit_driver(driver)
+        else:
+            self.idle.put(driver)
+        self.slots.release()
+        
+    @contextlib.contextmanager
+    def driver(self, timeout=None):
+        """
+        Context manager which lends a driver from the pool. A driver which raised is not reused.
+        """
+        driver=self.acquire(timeout)
+        ok=False
+        try:
+            yield driver
+            ok=True
+        finally:
+            self.release(driver,discard=not ok)
+            
+    def close(self):
+        import queue
+        
+        self.closed=True
+        while True:
+            try:
+                self.quit_driver(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+_browser_pool=None
+
+def get_browser_pool(**kwargs):
+    """
+    Returns the process-wide BrowserPool, creating it with kwargs on first use.
+    """
+    global _browser_pool
+    if _browser_pool is None:
+        import atexit
+        _browser_pool=BrowserPool(**kwargs)
+        atexit.register(_browser_pool.close)
+    return _browser_pool
+
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
+}
+
+HTTP_CACHE_DIR=os.getenv("MM_HTTP_CACHE_DIR",os.path.join(os.path.expanduser("~"),".cache","mmtest","http"))
+HTTP_CACHE_MAX_BYTES=int(os.getenv("MM_HTTP_CACHE_MAX_BYTES",str(256*1024*1024)))
+
+@functools.lru_cache(maxsize=1)
+def get_http_session():
+    """
+    Returns the process-wide requests session. Connections are pooled and kept alive
+    between fetches and failed GETs are retried with backoff.
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    retries=Retry(total=3,backoff_factor=0.5,status_forcelist=(429,500,502,503,504),
+                  allowed_methods=frozenset(['GET','HEAD']))
+    adapter=HTTPAdapter(pool_connections=10,pool_maxsize=10,max_retries=retries)
+    session=requests.Session()
+    session.headers.update(BROWSER_HEADERS)
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
+    return session
+
+def _cached_response(url, meta, body):
+    response=requests.models.Response()
+    response.status_code=200
+    response._content=body
+    response.headers=requests.structures.CaseInsensitiveDict(meta['headers'])
+    response.url=url
+    response.encoding=requests.utils.get_encoding_from_headers(response.headers)
+    response.from_cache=True
+    return response
+
+def _replace_file(path, content):
+    """writes content next to path under a unique name, then moves it into place"""
+    import tempfile
+    
+    handle,temp_path=tempfile.mkstemp(dir=os.path.dirname(path),suffix='.tmp')
+    try:
+        with os.fdopen(handle,'wb') as temp_file:
+            temp_file.write(content)
+        os.replace(temp_path,path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def _evict_http_cache(cache_dir, max_bytes):
+    """removes the least recently used responses until cache_dir fits in max_bytes"""
+    entries={}
+    for entry in os.scandir(cache_dir):
+        key,ext=os.path.splitext(entry.name)
+        if ext not in ('.json','.body'):
+            continue
+        try:
+            stat=entry.stat()
+        except OSError:
+            continue
+        used,size,paths=entries.get(key,(0,0,[]))
+        entries[key]=(max(used,stat.st_mtime),size+stat.st_size,paths+[entry.path])
+    total=sum(size for _,size,_ in entries.values())
+    for _,size,paths in sorted(entries.values()):
+        if total<=max_bytes:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total-=size
+
+def cached_get(url, timeout=10, cache_dir=None, max_bytes=None):
+    """
+    GETs url through the shared session with an on-disk cache.
+    
+    Responses carrying an ETag or Last-Modified header are stored. While a stored
+    response is fresh by its Cache-Control max-age it is returned without a request;
+    after that it is revalidated with a conditional GET and reused on a 304.
+    When the cache grows past max_bytes the least recently used responses are removed.
+    
+    Args:
+        url (str): the url to get.
+        timeout (float, optional): seconds to wait for the server.
+        cache_dir (str, optional): where responses are stored. Defaults to HTTP_CACHE_DIR.
+        max_bytes (int, optional): size limit of the cache. Defaults to HTTP_CACHE_MAX_BYTES.
+        
+    Returns:
+        requests.Response: the response, with from_cache set if the body came from disk.
+    """
+    import hashlib
+    import json
+    import time
+    
+    cache_dir=cache_dir or HTTP_CACHE_DIR
+    max_bytes=HTTP_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    key=hashlib.sha256(url.encode('utf-8')).hexdigest()
+    meta_path=os.path.join(cache_dir,key+'.json')
+    body_path=os.path.join(cache_dir,key+'.body')
+    meta=None
+    try:
+        with open(meta_path,'r',encoding='utf-8') as meta_file:
+            meta=json.load(meta_file)
+    except (OSError,ValueError):
+        pass
+    
+    def load_body():
+        with open(body_path,'rb') as body_file:
+            body=body_file.read()
+        try:
+            os.utime(body_path) #mark as recently used
+        except OSError:
+            pass
+        return body
+        
+    def freshness(headers):
+        #seconds the response stays fresh, or None if the headers don't say
+        cache_control=headers.get('Cache-Control','').lower()
+        if 'no-cache' in cache_control:
+            return 0
+        max_age=re.search(r'max-age=(\d+)',cache_control)
+        return int(max_age.group(1)) if max_age else None
+        
+    def save(meta, body=None):
+        try:
+            os.makedirs(cache_dir,exist_ok=True)
+            if body is not None:
+                _replace_file(body_path,body)
+            _replace_file(meta_path,json.dumps(meta).encode('utf-8'))
+            _evict_http_cache(cache_dir,max_bytes)
+        except OSError as e:
+            print(f"could not cache {url}: {e}")
+        
+    headers={}
+    if meta:
+        if time.time()<meta['stored']+meta['max_age']:
+            try:
+                return _cached_response(url,meta,load_body())
+            except OSError:
+                meta=None
+        if meta and meta['headers'].get('ETag'):
+            headers['If-None-Match']=meta['headers']['ETag']
+        if meta and meta['headers'].get('Last-Modified'):
+            headers['If-Modified-Since']=meta['headers']['Last-Modified']
+    response=get_http_session().get(url,headers=headers,timeout=timeout)
+    if response.status_code==304 and meta:
+        try:
+            body=load_body()
+        except OSError: #body lost. fetch unconditionally
+            response=get_http_session().get(url,timeout=timeout)
+        else:
+            meta['stored']=time.time()
+            max_age=freshness(response.headers)
+            meta['max_age']=max_age if max_age is not None else meta['max_age']
+            save(meta)
+            return _cached_response(url,meta,body)
+    if response.status_code==200 and 'no-store' not in response.headers.get('Cache-Control','').lower():
+        kept={name:response.headers[name] for name in ('Content-Type','ETag','Last-Modified','Cache-Control')
+              if name in response.headers}
+        max_age=freshness(response.headers) or 0
+        if 'ETag' in kept or 'Last-Modified' in kept or max_age:
+            save({"url":url,"headers":kept,"stored":time.time(),"max_age":max_age},
+                 response.content)
+    response.from_cache=False
+    return response
+
+def looks_like_js_shell(html, text, min_chars=500):
+    """
+    Guesses whether a page needs a browser to render its text.
+    
+    Args:
+        html (str): the page as served.
+        text (str): the text extracted from it.
+        min_chars (int, optional): less text than this always counts as a shell.
+    """
+    text=text.strip()
+    if len(text)<min_chars:
+        return True
+    lowered=html.lower()
+    if len(text)<5*min_chars and ('enable javascript' in lowered or 'requires javascript' in lowered):
+        return True
+    # mostly script with little text, as in single-page apps
+    return lowered.count('<script')>10 and len(text)<0.02*len(html)
+
+_host_tiers={} #host -> 'http' or 'browser', whichever last produced the page text
+
+def load_text_from_url(url,timeout=10,acquire_timeout=None,min_chars=500):
+    """
+    Returns the text of the document at url.
+    
+    Files and pages with static extensions are fetched with a plain GET. Other pages
+    are also tried with a plain GET first and only rendered in a headless browser when
+    the text extracted is empty, too short or looks like a javascript shell. The tier
+    which worked is remembered per host so later fetches go straight to it.
+    """
+    import mimetypes
+    from urllib.parse import urlsplit
     
     the_split=url.split(".") #try to split out type
     if the_split[-1] in ['html','docx','text','txt','pdf']: #if likely s static page or file
-        headers = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
-        }
-        response = requests.get(url,headers=headers,timeout=timeout)
+        response = cached_get(url,timeout=timeout)
         response.raise_for_status() #caller will have to deal with error
         content_type = response.headers['Content-Type'].split(';')[0]
         content_type=(mimetypes.guess_extension(content_type))
@@ -377,25 +1942,39 @@ def load_text_from_url(url,timeout=10):
         if content_type not in [['html','docx','txt','pdf']]: #if we don't recognize it
             content_type=the_split[-1] #use it from file name
         return extract_text(response.content,content_type)
-    else: #if not known to be static page
-        firefoxOptions = Options()
-        firefoxOptions.add_argument("--headless")
-        service = Service(GeckoDriverManager().install())
-        driver = webdriver.Firefox(
-            options=firefoxOptions,
-            service=service,
-        )
+    
+    host=urlsplit(url).netloc
+    http_text=""
+    if _host_tiers.get(host)!='browser':
+        try:
+            response = cached_get(url,timeout=timeout)
+            response.raise_for_status()
+            content_type=mimetypes.guess_extension(response.headers.get('Content-Type','text/html').split(';')[0]) or '.html'
+            content_type=content_type[1:]
+            if content_type in ['docx','txt','pdf']: #a file with no extension in its url
+                _host_tiers[host]='http'
+                return extract_text(response.content,content_type)
+            http_text=extract_text(response.content,"html")
+            if not looks_like_js_shell(response.text,http_text,min_chars):
+                _host_tiers[host]='http'
+                return http_text
+        except requests.exceptions.RequestException as e:
+            print(f"plain fetch of {url} failed: {e}")
+        print(f"rendering {url} in browser")
+        
+    with get_browser_pool().driver(acquire_timeout) as driver:
         driver.set_page_load_timeout(timeout)
         driver.get(url)
-        return extract_text(driver.page_source,"html")
+        page_source=driver.page_source
+    browser_text=extract_text(page_source,"html")
+    _host_tiers[host]='browser' if len(browser_text.strip())>len(http_text.strip()) else 'http'
+    return browser_text
             
     
 
 def extract_text_from_path_or_url(path_or_url,content=None,timeout=5):
-    import requests
     from bs4 import BeautifulSoup
     from docx import Document
-    import fitz
     import io
     import mimetypes
     if not content:
@@ -403,10 +1982,7 @@ def extract_text_from_path_or_url(path_or_url,content=None,timeout=5):
     content_type = ""
 
     if path_or_url.startswith(('http://', 'https://')):
-        headers = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
-}
-        response = requests.get(path_or_url,headers=headers,timeout=timeout)
+        response = cached_get(path_or_url,timeout=timeout)
         response.raise_for_status() #caller will have to deal with error
         content = response.content
         content_type = response.headers['Content-Type'].split(';')[0]
@@ -422,17 +1998,100 @@ def extract_text_from_path_or_url(path_or_url,content=None,timeout=5):
     elif 'docx' == content_type:
         return "\n".join([paragraph.text for paragraph in Document(io.BytesIO(content)).paragraphs])
     elif 'pdf' == content_type:
-        text = []
-        with fitz.open(stream=content, filetype="pdf") as doc:
-            for page in doc:
-                text.append(page.get_text())
-        return text
+        return extract_pdf_text(content)
     elif 'txt' == content_type:
         return content.decode('utf-8')
     else:
         raise ValueError("Unsupported file type or content")
 
 
+def render_smartstory(markdown_text, video_filepath, word_index=None, quote_records=None, title=None, date=None,
+                      smart_transcript=None, scrub_text=True, fuzzy_ratio=0.8, player='inline'):
+    """
+    Renders an article written in markdown straight to a SmartStory page with a video
+    clip before each quote which can be found in the timed transcript.
+    
+    The markdown token stream is walked once and the final html emitted directly, so
+    there is no second parse of the page. The same input always gives the same bytes.
+    
+    Args:
+        markdown_text (str): The article.
+        video_filepath (str): url of the meeting video; .m3u8 or anything playable by a <video> tag.
+        word_index (WordIndex, optional): index of the timed transcript.
+        quote_records (list, optional): records from verify_quotes with clip times.
+        title, date, smart_transcript: as for markdown_to_html.
+        scrub_text (bool, optional): replace curly quotes and dashes before rendering.
+        fuzzy_ratio (float, optional): see clip_finder.
+        player (str, optional): 'inline' puts a video player before each quote. 'shared'
+            makes each quote a button which plays its clip in a single player which
+            loads the video only when a quote is first clicked.
+        
+    Returns:
+        tuple: the html string and a list of quotes for which no clip was found.
+    """
+    from html import escape
+    from markdown_it import MarkdownIt
+    
+    if scrub_text:
+        markdown_text=replace_special_characters(markdown_text)
+    is_m3u8 = video_filepath.lower().endswith('.m3u8')
+    find_clip_for_quote=clip_finder(word_index,quote_records,fuzzy_ratio)
+    not_found=[]
+    
+    def video_tag(clip):
+        if is_m3u8:
+            return f'<video controls data-hls="{escape(video_filepath)}" data-start="{clip[0]}" data-end="{clip[1]}"></video>'
+        return f'<video controls src="{escape(video_filepath)}#t={clip[0]},{clip[1]}" crossorigin="anonymous"></video>'
+    
+    def clip_quote(quote, clip):
+        if player=='shared':
+            return f'<span class="clip" role="button" tabindex="0" data-start="{clip[0]}" data-end="{clip[1]}">{quote}</span>'
+        return f'{video_tag(clip)}<span>{quote}</span>'
+    
+    def render_text(self, tokens, idx, options, env):
+        text=tokens[idx].content
+        if not tokens[idx].meta.get('quotes'):
+            return escape(text,quote=False)
+        pieces=[]
+        position=0
+        for match in re.finditer(r'([\"“”])(.*?)([\"“”])',text):
+            clip=find_clip_for_quote(match.group(2))
+            if clip is None:
+                print(f'Quote not found: {match.group(2)}')
+                not_found.append(match.group(2))
+                continue
+            pieces.append(escape(text[position:match.start()],quote=False))
+            pieces.append(clip_quote(escape(match.group(0),quote=False),clip))
+            position=match.end()
+        pieces.append(escape(text[position:],quote=False))
+        return "".join(pieces)
+    
+    md=MarkdownIt()
+    md.add_render_rule('text',render_text)
+    tokens=md.parse(markdown_text)
+    for i,token in enumerate(tokens):
+        # quotes are only looked for in paragraphs
+        if token.type=='inline' and i>0 and tokens[i-1].type=='paragraph_open' and not tokens[i-1].hidden:
+            for child in token.children:
+                if child.type=='text':
+                    child.meta['quotes']=True
+    html_content=md.renderer.render(tokens,md.options,{})
+    
+    if player=='shared':
+        hls_attribute=f' data-hls="{HLS_SCRIPT_URL}"' if is_m3u8 else ''
+        html_content=(f'<video id="clip-player" controls playsinline preload="none"'
+                      f' data-src="{escape(video_filepath)}"{hls_attribute}></video>\n{html_content}')
+        head_extra=f"\n    <style>{CLIP_CSS}{SHARED_PLAYER_CSS}</style>"
+        body_extra=f"\n    <script>{SHARED_PLAYER_SCRIPT}</script>"
+    else:
+        head_extra=f"\n    <style>{CLIP_CSS}</style>"
+        body_extra=""
+        if is_m3u8:
+            head_extra+=f'\n    <script src="{HLS_SCRIPT_URL}"></script>'
+            body_extra=f"\n    <script>{HLS_INIT_SCRIPT}</script>"
+    return html_page(html_content,title=title,date=date,smart_transcript=smart_transcript,
+                     head_extra=head_extra,body_extra=body_extra),not_found
+
 def extract_text_from_pdf(
         pdf_content: bytes=Field(definition ="binary content of a pdf")):
     #deprecated
@@ -0,0 +1,63 @@
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class LocalServer:
+    """
+    HTTP server on a free local port. routes maps a path to a function taking the
+    request handler and returning (status, headers, body). Every request is recorded
+    in requests as (method, path, headers).
+    """
+    def __init__(self):
+        server=self
+        self.routes={}
+        self.requests=[]
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version="HTTP/1.1"
+
+            def handle_request(self):
+                length=int(self.headers.get('Content-Length') or 0)
+                self.body=self.rfile.read(length) if length else b""
+                server.requests.append((self.command,self.path,self.headers))
+                route=server.routes.get(self.path.split('?')[0])
+                status,headers,body=route(self) if route else (404,{},b"not found")
+                body=body.encode('utf-8') if isinstance(body,str) else body
+                self.send_response(status)
+                for name,value in headers.items():
+                    self.send_header(name,value)
+                if status!=304:
+                    self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                if status!=304:
+                    self.wfile.write(body)
+
+            do_GET=handle_request
+            do_POST=handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd=http.server.ThreadingHTTPServer(('127.0.0.1',0),Handler)
+        self.thread=threading.Thread(target=self.httpd.serve_forever,daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_port}{path}"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def local_server():
+    server=LocalServer()
+    yield server
+    server.close()
@@ -0,0 +1,144 @@
+import threading
+import urllib.request
+
+import pytest
+
+import mytools
+from mytools import BrowserPool
+
+
+class StubDriver:
+    """Stands in for a selenium Firefox driver. Pages are fetched with urllib."""
+    def __init__(self):
+        self.page_source=""
+        self.broken=False
+        self.quit_count=0
+
+    def set_page_load_timeout(self, timeout):
+        self.timeout=timeout
+
+    def get(self, url):
+        with urllib.request.urlopen(url,timeout=5) as response:
+            self.page_source=response.read().decode('utf-8')
+
+    def execute_script(self, script):
+        if self.broken:
+            raise RuntimeError("browser has gone away")
+        return 1
+
+    def quit(self):
+        self.quit_count+=1
+
+
+class StubPool(BrowserPool):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.created=[]
+
+    def new_driver(self):
+        driver=StubDriver()
+        with self.lock:
+            self.pages[driver]=0
+        self.created.append(driver)
+        return driver
+
+
+@pytest.fixture
+def page(local_server):
+    local_server.routes['/page']=lambda request:(200,{'Content-Type':'text/html'},"<p>rendered page</p>")
+    return local_server.url('/page')
+
+
+def test_driver_is_reused(page):
+    pool=StubPool(max_size=1,max_pages=10)
+    with pool.driver() as first:
+        first.get(page)
+        assert "rendered page" in first.page_source
+    with pool.driver() as second:
+        second.get(page)
+    assert second is first
+    assert len(pool.created)==1
+    assert first.quit_count==0
+
+
+def test_driver_is_replaced_after_max_pages(page):
+    pool=StubPool(max_size=1,max_pages=2)
+    for _ in range(2):
+        with pool.driver() as driver:
+            driver.get(page)
+    first=pool.created[0]
+    assert first.quit_count==1
+    with pool.driver() as driver:
+        driver.get(page)
+    assert driver is not first
+    assert len(pool.created)==2
+
+
+def test_unhealthy_idle_driver_is_replaced(page):
+    pool=StubPool(max_size=1)
+    with pool.driver() as first:
+        first.get(page)
+    first.broken=True
+    with pool.driver() as second:
+        second.get(page)
+    assert second is not first
+    assert first.quit_count==1
+
+
+def test_driver_which_raised_is_discarded(page):
+    pool=StubPool(max_size=1)
+    with pytest.raises(ValueError):
+        with pool.driver() as first:
+            first.get(page)
+            raise ValueError("page did not parse")
+    assert first.quit_count==1
+    with pool.driver() as second:
+        assert second is not first
+
+
+def test_acquire_times_out_when_pool_is_busy():
+    pool=StubPool(max_size=1)
+    driver=pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire(timeout=0.1)
+    pool.release(driver)
+    waiter=threading.Thread(target=lambda:pool.release(pool.acquire(timeout=1)))
+    waiter.start()
+    waiter.join()
+    assert len(pool.created)==1
+
+
+def test_close_quits_idle_and_returned_drivers(page):
+    pool=StubPool(max_size=2)
+    idle=pool.acquire()
+    busy=pool.acquire()
+    pool.release(idle)
+    pool.close()
+    assert idle.quit_count==1
+    assert busy.quit_count==0
+    pool.release(busy)
+    assert busy.quit_count==1
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+
+def test_load_text_from_url_renders_shell_pages_in_pool(local_server, monkeypatch, tmp_path):
+    text="The council approved the budget after a long debate. "*20
+    shell="<html><body><p>Please enable JavaScript to view this page.</p></body></html>"
+
+    def app(request):
+        rendered=request.headers.get('User-Agent','').startswith('Python-urllib') #only the stub driver
+        return 200,{'Content-Type':'text/html'},f"<html><body><p>{text}</p></body></html>" if rendered else shell
+
+    local_server.routes['/app']=app
+    pool=StubPool(max_size=1)
+    monkeypatch.setattr(mytools,'_browser_pool',pool)
+    monkeypatch.setattr(mytools,'HTTP_CACHE_DIR',str(tmp_path))
+    url=local_server.url('/app')
+
+    assert "approved the budget" in mytools.load_text_from_url(url)
+    assert "approved the budget" in mytools.load_text_from_url(url)
+    plain=[path for method,path,headers in local_server.requests
+           if not headers.get('User-Agent','').startswith('Python-urllib')]
+    assert plain==['/app'] #the host is remembered as needing the browser
+    assert len(pool.created)==1
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+
+import mytools
+from mytools import cached_get
+
+
+def versioned(body, etag='"v1"', cache_control='max-age=0'):
+    """route which answers a matching If-None-Match with 304"""
+    def route(request):
+        headers={'Content-Type':'text/html','ETag':etag,'Cache-Control':cache_control}
+        if request.headers.get('If-None-Match')==etag:
+            return 304,headers,b""
+        return 200,headers,body
+    return route
+
+
+def test_revalidates_with_etag_and_reuses_body_on_304(local_server, tmp_path):
+    local_server.routes['/doc']=versioned("<p>minutes</p>")
+    url=local_server.url('/doc')
+
+    first=cached_get(url,cache_dir=str(tmp_path))
+    second=cached_get(url,cache_dir=str(tmp_path))
+
+    assert first.from_cache is False
+    assert second.from_cache is True
+    assert second.status_code==200
+    assert second.text=="<p>minutes</p>"
+    assert second.headers['ETag']=='"v1"'
+    conditions=[headers.get('If-None-Match') for method,path,headers in local_server.requests]
+    assert conditions==[None,'"v1"']
+
+
+def test_fresh_response_is_served_without_request(local_server, tmp_path):
+    local_server.routes['/doc']=versioned("<p>agenda</p>",cache_control='max-age=3600')
+    url=local_server.url('/doc')
+
+    cached_get(url,cache_dir=str(tmp_path))
+    response=cached_get(url,cache_dir=str(tmp_path))
+
+    assert response.from_cache is True
+    assert response.text=="<p>agenda</p>"
+    assert len(local_server.requests)==1
+
+
+def test_changed_document_replaces_cached_body(local_server, tmp_path):
+    local_server.routes['/doc']=versioned("<p>draft</p>")
+    url=local_server.url('/doc')
+    cached_get(url,cache_dir=str(tmp_path))
+
+    local_server.routes['/doc']=versioned("<p>final</p>",etag='"v2"')
+    changed=cached_get(url,cache_dir=str(tmp_path))
+    again=cached_get(url,cache_dir=str(tmp_path))
+
+    assert changed.from_cache is False
+    assert changed.text=="<p>final</p>"
+    assert again.from_cache is True
+    assert again.text=="<p>final</p>"
+
+
+def test_lost_body_is_fetched_again(local_server, tmp_path):
+    local_server.routes['/doc']=versioned("<p>minutes</p>")
+    url=local_server.url('/doc')
+    cached_get(url,cache_dir=str(tmp_path))
+    for name in os.listdir(tmp_path):
+        if name.endswith('.body'):
+            os.remove(tmp_path/name)
+
+    response=cached_get(url,cache_dir=str(tmp_path))
+
+    assert response.status_code==200
+    assert response.text=="<p>minutes</p>"
+    assert local_server.requests[-1][2].get('If-None-Match') is None
+
+
+def test_no_store_response_is_not_cached(local_server, tmp_path):
+    local_server.routes['/doc']=versioned("<p>private</p>",cache_control='no-store')
+
+    cached_get(local_server.url('/doc'),cache_dir=str(tmp_path))
+
+    assert os.listdir(tmp_path)==[]
+
+
+def test_least_recently_used_responses_are_evicted(local_server, tmp_path):
+    for path in ('/a','/b','/c'):
+        local_server.routes[path]=versioned("x"*1000)
+    cache_dir=str(tmp_path)
+    key=lambda path:hashlib.sha256(local_server.url(path).encode('utf-8')).hexdigest()
+
+    cached_get(local_server.url('/a'),cache_dir=cache_dir,max_bytes=2500)
+    cached_get(local_server.url('/b'),cache_dir=cache_dir,max_bytes=2500)
+    for name in os.listdir(tmp_path):
+        if not name.startswith(key('/a')):
+            os.utime(tmp_path/name,(0,0)) #/b is now the least recently used
+    cached_get(local_server.url('/c'),cache_dir=cache_dir,max_bytes=2500)
+
+    kept={path.stem for path in tmp_path.iterdir()}
+    assert kept=={key('/a'),key('/c')}
+    assert sum(path.stat().st_size for path in tmp_path.iterdir())<=2500
+    assert not [path for path in tmp_path.iterdir() if path.suffix=='.tmp']
+
+
+def test_default_cache_dir(local_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(mytools,'HTTP_CACHE_DIR',str(tmp_path))
+    local_server.routes['/doc']=versioned("<p>minutes</p>")
+
+    cached_get(local_server.url('/doc'))
+
+    assert sorted(path.suffix for path in tmp_path.iterdir())==['.body','.json']
+
+
+
+def test_max_age_zero_on_304_makes_entry_stale(local_server, tmp_path):
+    local_server.routes['/doc']=versioned("<p>minutes</p>",cache_control='max-age=3600')
+    url=local_server.url('/doc')
+    cached_get(url,cache_dir=str(tmp_path))
+    meta_path=next(tmp_path.glob('*.json'))
+    meta=json.loads(meta_path.read_text())
+    meta['stored']=0 #expired long ago
+    meta_path.write_text(json.dumps(meta))
+
+    local_server.routes['/doc']=versioned("<p>minutes</p>",cache_control='max-age=0')
+    revalidated=cached_get(url,cache_dir=str(tmp_path))
+    again=cached_get(url,cache_dir=str(tmp_path))
+
+    assert revalidated.from_cache is True
+    assert again.from_cache is True
+    assert len(local_server.requests)==3 #the 304 said stale, so the third call asks again
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import mm_agent
+from llm_cache import SQLiteLLMCache
+from mm_agent import chat_model
+
+
+def completion(content):
+    return {"id":"chatcmpl-test","object":"chat.completion","created":0,"model":mm_agent.MODEL,
+            "choices":[{"index":0,"message":{"role":"assistant","content":content},"finish_reason":"stop"}],
+            "usage":{"prompt_tokens":12,"completion_tokens":3,"total_tokens":15}}
+
+
+@pytest.fixture
+def provider(local_server, monkeypatch, tmp_path):
+    """local server answering chat completions, with a fresh registry and response cache"""
+    ports=[]
+
+    def chat(request):
+        ports.append(request.client_address[1])
+        prompt=json.loads(request.body)["messages"][-1]["content"]
+        return 200,{'Content-Type':'application/json'},json.dumps(completion(f"echo: {prompt}"))
+
+    local_server.routes['/v1/chat/completions']=chat
+    local_server.ports=ports
+    cache=SQLiteLLMCache(str(tmp_path/"llm_cache.sqlite"))
+    monkeypatch.setenv("OPENAI_API_KEY","test-key")
+    monkeypatch.setenv("OPENAI_BASE_URL",local_server.url('/v1'))
+    monkeypatch.setattr(mm_agent,'_chat_models',{})
+    monkeypatch.setattr(mm_agent,'get_llm_cache',lambda:cache)
+    return local_server
+
+
+def test_same_settings_share_a_client(provider):
+    assert chat_model("writer",.2) is chat_model("writer",.2)
+    assert chat_model("critique",.2) is chat_model("critique",.2)
+    assert chat_model("writer",.2) is chat_model("outliner",.2) #both cached at this temperature
+
+
+def test_different_settings_get_their_own_client(provider, monkeypatch):
+    writer=chat_model("writer",.2)
+    assert chat_model("writer",.7) is not writer
+    assert chat_model("writer",.2,max_tokens=100) is not writer
+    assert chat_model("critique",.2) is not writer #never cached
+    monkeypatch.setenv("OPENAI_API_KEY","other-key")
+    assert chat_model("writer",.2) is not writer
+    monkeypatch.setenv("OPENAI_API_KEY","test-key")
+    monkeypatch.setenv("OPENAI_BASE_URL",provider.url('/other/v1'))
+    assert chat_model("writer",.2) is not writer
+    assert len(mm_agent._chat_models)==6
+
+
+def test_shared_client_reuses_its_connection(provider):
+    first=chat_model("critique",.2).invoke("first")
+    second=chat_model("critique",.2).invoke("second")
+    assert first.content=="echo: first"
+    assert second.content=="echo: second"
+    assert len(provider.ports)==2
+    assert provider.ports[0]==provider.ports[1] #same keep-alive connection
+
+
+def test_cached_client_answers_repeats_from_cache(provider):
+    first=chat_model("writer",0).invoke("same prompt")
+    second=chat_model("writer",0).invoke("same prompt")
+    assert first.content==second.content=="echo: same prompt"
+    assert len(provider.ports)==1
@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+import mytools
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(mytools,'_prefetched',mytools.collections.OrderedDict())
+    return mytools._prefetched
+
+
+def test_failed_prefetch_is_fetched_again(monkeypatch, registry):
+    calls=[]
+
+    def fetch(url):
+        calls.append(url)
+        if len(calls)==1:
+            raise ValueError(f"could not download timing data from {url}")
+        return "index"
+
+    monkeypatch.setattr(mytools,'fetch_word_index',fetch)
+    mytools.prefetch_word_index("http://example.test/words.bin").exception(5)
+
+    assert mytools.get_word_index("http://example.test/words.bin",timeout=5)=="index"
+    assert len(calls)==2
+    assert not registry
+
+
+def test_wait_timeout_is_raised(monkeypatch, registry):
+    release=threading.Event()
+    monkeypatch.setattr(mytools,'fetch_word_index',lambda url:release.wait(5))
+    try:
+        with pytest.raises(TimeoutError):
+            mytools.get_word_index("http://example.test/slow.bin",timeout=0.1)
+    finally:
+        release.set()
+
+
+def test_registry_keeps_only_the_newest_prefetches(monkeypatch, registry):
+    monkeypatch.setattr(mytools,'PREFETCH_MAX_ENTRIES',3)
+    futures=[mytools.prefetch(('words',n),lambda n:n,n) for n in range(5)]
+    assert list(registry)==[('words',2),('words',3),('words',4)]
+    assert [future.result(5) for future in futures[2:]]==[2,3,4]
+    mytools.prefetch(('words',2),lambda n:n,2) #used again, so kept longest
+    mytools.prefetch(('words',5),lambda n:n,5)
+    assert list(registry)==[('words',4),('words',2),('words',5)]
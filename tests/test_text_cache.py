@@ -0,0 +1,48 @@
+import os
+import threading
+
+from mytools import TextCache
+
+
+def test_concurrent_puts_of_one_entry(tmp_path):
+    cache=TextCache(str(tmp_path))
+    key=TextCache.key(b"%PDF minutes","pdf")
+    start=threading.Barrier(8)
+
+    def put(n):
+        start.wait()
+        cache.put(key,{"text":f"minutes {n}"*1000})
+
+    threads=[threading.Thread(target=put,args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.get(key)["text"].startswith("minutes ")
+    assert os.listdir(tmp_path)==[key+'.json']
+
+
+def test_evict_removes_abandoned_temp_files(tmp_path):
+    cache=TextCache(str(tmp_path))
+    abandoned=tmp_path/"abandoned.tmp"
+    abandoned.write_text("half written")
+    os.utime(abandoned,(0,0))
+    writing=tmp_path/"writing.tmp"
+    writing.write_text("being written")
+
+    cache.put(TextCache.key(b"agenda","html"),{"text":"agenda"})
+
+    assert not abandoned.exists()
+    assert writing.exists()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache=TextCache(str(tmp_path),max_bytes=2500)
+    keys=[TextCache.key(name,"txt") for name in (b"a",b"b",b"c")]
+    cache.put(keys[0],{"text":"x"*1000})
+    cache.put(keys[1],{"text":"x"*1000})
+    os.utime(cache.path(keys[1]),(0,0))
+    cache.put(keys[2],{"text":"x"*1000})
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
@@ -0,0 +1,35 @@
+import threading
+
+from mytools import TranscriptIndex
+
+
+TRANSCRIPT=("The chair called the meeting to order. Council member Diaz said, \"We cannot keep "
+            "deferring the roof repairs at the library.\" The motion to fund them passed five to two. ")*50
+
+
+def test_fuzzy_find_returns_transcript_offsets():
+    index=TranscriptIndex(TRANSCRIPT)
+    match=index.fuzzy_find("we can't keep deferring the roof repairs at the library")
+    assert match is not None
+    assert TRANSCRIPT[match['start']:match['end']]==match['text']
+    assert "We cannot keep deferring" in match['text']
+
+
+def test_concurrent_first_fuzzy_find_builds_one_aligner():
+    index=TranscriptIndex(TRANSCRIPT)
+    quote="the motion to fund them passed five to 2"
+    expected=TranscriptIndex(TRANSCRIPT).fuzzy_find(quote)
+    start=threading.Barrier(8)
+    results=[]
+
+    def find():
+        start.wait()
+        results.append(index.fuzzy_find(quote))
+
+    threads=[threading.Thread(target=find) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results==[expected]*8
+    assert len(index.word_spans)==len(TRANSCRIPT.split())